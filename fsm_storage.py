@@ -0,0 +1,96 @@
+# fsm_storage.py
+
+import collections
+import json
+import time
+from typing import Any, Callable, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+
+class SQLiteStorage(BaseStorage):
+    # Хранилище FSM в общей SQLite-базе: состояние переживает перезапуск и доступно всем процессам бота.
+    # Поверх базы - небольшой LRU-кэш чтения. Он согласован, пока апдейты одного игрока
+    # обрабатывает один процесс; записи всегда идут в базу сразу.
+    def __init__(self, connect: Callable, state_ttl: int, cache_size: int = 10000, clock: Callable = time.time):
+        self.connect = connect
+        self.state_ttl = state_ttl
+        self.cache_size = cache_size
+        self.clock = clock
+        self.cache = collections.OrderedDict()
+
+    @staticmethod
+    def _build_key(key: StorageKey) -> str:
+        return ':'.join((str(key.bot_id), str(key.chat_id), str(key.user_id), str(key.thread_id or ''),
+                         key.business_connection_id or '', key.destiny))
+
+    def _remember(self, storage_key: str, state: Optional[str], data: Dict[str, Any], updated_at: int):
+        self.cache[storage_key] = (state, data, updated_at)
+        self.cache.move_to_end(storage_key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _load(self, storage_key: str) -> tuple:
+        now = int(self.clock())
+        cached = self.cache.get(storage_key)
+        if cached and cached[2] >= now - self.state_ttl:
+            self.cache.move_to_end(storage_key)
+            return cached
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, data, updated_at FROM fsm_storage WHERE storage_key = ?", (storage_key,))
+            row = cursor.fetchone()
+        if row and row[2] >= now - self.state_ttl:
+            entry = (row[0], json.loads(row[1]) if row[1] else {}, row[2])
+        else:
+            entry = (None, {}, now)
+        self._remember(storage_key, *entry)
+        return entry
+
+    def _save(self, storage_key: str, state: Optional[str], data: Dict[str, Any]):
+        current_state, current_data, _ = self._load(storage_key)
+        if current_state == state and current_data == data:
+            # Типичный state.clear() на каждом нажатии ничего не меняет - в базу не ходим
+            return
+        now = int(self.clock())
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            if state is None and not data:
+                cursor.execute("DELETE FROM fsm_storage WHERE storage_key = ?", (storage_key,))
+            else:
+                cursor.execute(
+                    "REPLACE INTO fsm_storage (storage_key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                    (storage_key, state, json.dumps(data, ensure_ascii=False, separators=(',', ':')) if data else None, now))
+            conn.commit()
+        self._remember(storage_key, state, dict(data), now)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._build_key(key)
+        _, data, _ = self._load(storage_key)
+        self._save(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._load(self._build_key(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._build_key(key)
+        state, _, _ = self._load(storage_key)
+        self._save(storage_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(self._load(self._build_key(key))[1])
+
+    def purge_expired(self) -> int:
+        cutoff = int(self.clock()) - self.state_ttl
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (cutoff,))
+            conn.commit()
+            removed = cursor.rowcount
+        for storage_key in [k for k, entry in self.cache.items() if entry[2] < cutoff]:
+            del self.cache[storage_key]
+        return removed
+
+    async def close(self) -> None:
+        self.cache.clear()
@@ -133,6 +133,14 @@ LEXICON_RU = {
     'defenseless_attack_report': ('**Тема:** Налет на базу {target_name}\n**Итог:** Сопротивление не оказано. Сектор разграблен.\n\n'
                                   '**Добыча:** **{looted_resources}** 💰\n\n_Ваши войска не понесли потерь и возвращаются на базу._'),
     'attack_notification': '🚨 **ТРЕВОГА!** Ваша база атакована! Получен отчет о боевых действиях.',
+    'battle_journal_title': '`---= [ ЖУРНАЛ БОЁВ ] =---`\n*Страница {current_page} из {total_pages}*\n',
+    'battle_journal_empty': '`---= [ ЖУРНАЛ БОЁВ ] =---`\n\nЗаписей о боевых действиях пока нет.',
+    'battle_journal_line': '**{index}.** `{datetime}` {outcome} · {opponent_name} · `{loot:+d}` 💰',
+    'battle_journal_outcome_attack_win': '⚔️ Победа',
+    'battle_journal_outcome_attack_loss': '⚔️ Поражение',
+    'battle_journal_outcome_defense_win': '🛡️ Оборона удержана',
+    'battle_journal_outcome_defense_loss': '🛡️ Оборона прорвана',
+    'battle_journal_outcome_unknown': '📄 Отчет',
 
     # --- РЕЙТИНГИ ---
     'rating_menu_title': '`---= [ ЗАЛ СЛАВЫ ] =---`\n\n*Архивы содержат досье на самых выдающихся командиров сектора.*',
@@ -142,6 +150,15 @@ LEXICON_RU = {
     'rating_resources_title': '`--= 💰 Военные магнаты =--`\n*Самые состоятельные командующие*\n\n',
     'rating_no_players': 'В данной категории пока нет выдающихся командиров.',
     'rating_line': '{medal} **{rank}. Генерал {name}** - {metric}: {value}\n',
+    'rating_day_title': '`--= 📅 Итоги дня =--`\n*Лучшие командиры с полуночи по Москве*\n',
+    'rating_week_title': '`--= 🗓️ Итоги недели =--`\n*Лучшие командиры с понедельника*\n',
+    'rating_period_section': '\n`{title}`\n',
+    'rating_period_attack_wins': '⚔️ Победы в атаке',
+    'rating_period_attack_wins_metric': 'Побед',
+    'rating_period_loot': '💰 Захваченная добыча',
+    'rating_period_loot_metric': 'Добыча',
+    'rating_period_defenses_held': '🛡️ Удержанная оборона',
+    'rating_period_defenses_held_metric': 'Отбито атак',
 
 
     # --- ОШИБКИ И ВАЛИДАЦИЯ ---
@@ -156,6 +173,7 @@ LEXICON_RU = {
     'critical_battle_error': 'ВНИМАНИЕ! Произошла критическая ошибка в симуляции боя. Технический отдел уже уведомлен.',
     'error_training_in_progress': 'Казармы уже заняты подготовкой рекрутов, сэр!',
     'error_builder_busy': 'Строительный отдел занят! Новый приказ будет доступен после завершения текущего проекта.',
+    'throttled_alert': 'Не так быстро, командир! Штаб не успевает обрабатывать приказы.',
 
 
     # --- АДМИН-ПАНЕЛЬ ---
@@ -189,4 +207,38 @@ LEXICON_RU = {
     'dossier_process_construction': '  - `Строительство:` {building_name} (ур. {level}), до завершения: {time_left}',
     'dossier_process_training': '  - `Подготовка:` {unit_name} ({quantity} шт.), до след.: {time_left}',
     'dossier_process_attack_cooldown': '  - `Перегруппировка:` Активна, осталось: {time_left}',
+
+    # --- МЕТРИКИ ---
+    'admin_metrics_title': '`---= [ ТЕЛЕМЕТРИЯ ОБРАБОТЧИКОВ ] =---`\n*Задержки в мс, БД/API/CPU - p95*',
+    'admin_metrics_empty': 'Телеметрия пока не собрана.',
+    'admin_metrics_loop_lag': '**Лаг цикла событий:** p50/p95/p99 `{p50:.0f}/{p95:.0f}/{p99:.0f}` мс, зависаний: {stalls}',
+    'admin_metrics_line': ('`{handler}` - {calls} выз., {errors} ошиб.\n'
+                           '  p50/p95/p99: `{p50:.0f}/{p95:.0f}/{p99:.0f}` · БД `{db:.0f}` · API `{api:.0f}` · CPU `{cpu:.0f}`\n'
+                           '  Запросов/соединений (p95): `{queries:.0f}/{connections:.0f}`'),
+    'admin_sql_profile_title': '`---= [ ПРОФИЛЬ SQL ] =---`\n*Топ запросов по суммарному времени. Порог медленного запроса: {threshold:g} мс*',
+    'admin_sql_profile_empty': 'Запросов к БД пока не было.',
+    'admin_sql_profile_line': '`{sql}`\n  {calls} выз. · всего `{total:.0f}` мс · сред. `{avg:.2f}` · макс. `{max:.1f}`',
+    'admin_ledger_usage': 'Формат: `/ledger <ID>` - сверка с журналом, `/ledger <ID> rebuild` - восстановить ресурсы и армию по журналу.',
+    'admin_ledger_report': ('`---= [ ЖУРНАЛ: {name} | ID: {user_id} ] =---`\n'
+                            '**Событий:** {events}\n\n'
+                            '**По журналу:** `{ledger_resources}` 💰 · актив `{ledger_active}` · резерв `{ledger_reserve}`\n'
+                            '**В базе:** `{resources}` 💰 · актив `{active}` · резерв `{reserve}`\n\n{verdict}'),
+    'admin_ledger_ok': '✅ Состояние совпадает с журналом.',
+    'admin_ledger_mismatch': '⚠️ Состояние расходится с журналом!',
+    'admin_ledger_recent_title': '**Последние события:**',
+    'admin_ledger_event_line': '`{datetime}` `{event_type}` {deltas} {ref}',
+    'admin_ledger_rebuilt': '♻️ Ресурсы и армия восстановлены по журналу.',
+    'admin_search_prompt': ('Введите условия поиска через пробел:\n'
+                            '`all` - все игроки\n'
+                            '`Иван` - имя начинается с \"Иван\" (с учетом регистра)\n'
+                            '`power:100-500` - мощь в диапазоне (`power:1000-` - от 1000)\n'
+                            '`idle:7` - не заходил 7+ дней, `active:3` - заходил за последние 3 дня'),
+    'admin_search_bad_query': 'Не удалось разобрать условия. Пример: `power:100-500 active:7`',
+    'admin_search_title': '`---= [ ПОИСК: {query} ] =---`\n*Найдено: {total} · Страница {current_page} из {total_pages}*\n',
+    'admin_search_empty': 'Под условия не подходит ни один игрок.',
+    'admin_search_line': '**{index}.** {name} · `{user_id}` · мощь {power} · был {last_seen}',
+    'admin_bulk_resources_prompt': 'Сколько припасов начислить каждому найденному игроку (можно отрицательное)?',
+    'admin_bulk_soldiers_prompt': 'Сколько бойцов добавить в резерв каждому найденному игроку?',
+    'admin_bulk_done': '✅ Начислено {amount} {unit} каждому из {count} игроков.',
+    'admin_bulk_cooldowns_done': '✅ Кулдауны атаки и бонуса сброшены у {count} игроков.',
 }
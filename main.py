@@ -4,35 +4,201 @@ import random
 import time
 import datetime
 import json
+import zlib
 import sqlite3
 import os
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters.command import Command
+import contextvars
+import functools
+import hashlib
+import itertools
+import shutil
+import collections
+import heapq
+import sys
+import threading
+import traceback
+import signal
+import multiprocessing
+import zoneinfo
+import array
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
+from aiogram.filters.command import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.event.handler import CallableObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.exceptions import TelegramAPIError
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramBadRequest
 from typing import Union
 from aiogram.types import BotCommand
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import SendMessage, EditMessageText, EditMessageReplyMarkup, DeleteMessage
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # Импортируем наш лексикон полностью
 from lexicon import LEXICON_RU, LEXICON_COMMANDS_RU
+from fsm_storage import SQLiteStorage
 
 # ==============================================================================
 # --- НАСТРОЙКИ И КОНФИГУРАЦИЯ ---
 # ==============================================================================
 logging.basicConfig(level=logging.INFO)
 API_TOKEN = os.environ.get('TELEGRAM_API_TOKEN')
-DATABASE_NAME = '/var/data/wog_database.db'
+DATABASE_NAME = os.environ.get('WOG_DATABASE_NAME', '/var/data/wog_database.db')
 ADMIN_IDS = [5658493362]
 
+# Запись входящих апдейтов в лог и их детерминированное воспроизведение (пусто - выключено)
+UPDATES_RECORD_FILE = os.environ.get('WOG_RECORD_UPDATES')
+UPDATES_REPLAY_FILE = os.environ.get('WOG_REPLAY_UPDATES')
+
+# Метрики обработчиков: текстовый эндпоинт поднимается только если задан порт
+METRICS_HOST = os.environ.get('WOG_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('WOG_METRICS_PORT', '0'))
+METRICS_SAMPLE_SIZE = 2048
+
+# Профилировщик SQL: запросы дольше порога пишутся в лог вместе с параметрами и планом
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('WOG_SLOW_QUERY_MS', '50'))
+
+# Сторож цикла событий: как часто меряем задержку и с какой задержки считаем цикл заблокированным
+LOOP_LAG_INTERVAL = 0.25
+LOOP_LAG_THRESHOLD = float(os.environ.get('WOG_LOOP_LAG_THRESHOLD', '0.2'))
+
+# Режим вебхука: если задан WOG_WEBHOOK_URL, апдейты принимает локальный aiohttp-сервер вместо long polling
+WEBHOOK_BASE_URL = os.environ.get('WOG_WEBHOOK_URL')
+WEBHOOK_PATH = os.environ.get('WOG_WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WOG_WEBHOOK_SECRET')
+WEBHOOK_HOST = os.environ.get('WOG_WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WOG_WEBHOOK_PORT', '8080'))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WOG_WEBHOOK_MAX_CONNECTIONS', '40'))
+MAX_CONCURRENT_UPDATES = int(os.environ.get('WOG_MAX_CONCURRENT_UPDATES', '100'))
+# Кулдауны держим в памяти, только если все апдейты игрока обрабатывает один процесс (long polling, в том числе
+# с воркерами). За балансировщиком вебхуков экземпляров может быть несколько - там кулдауны проверяются по базе
+COOLDOWNS_IN_MEMORY = os.environ.get('WOG_COOLDOWNS_IN_MEMORY', '0' if WEBHOOK_BASE_URL else '1') == '1'
+# Альтернативный адрес Bot API: локальный сервер Telegram или заглушка для тестов
+TELEGRAM_API_SERVER = os.environ.get('WOG_TELEGRAM_API_SERVER')
+
+# Состояния FSM хранятся в БД; брошенные диалоги удаляются через сутки
+FSM_STATE_TTL_SECONDS = 24 * 3600
+FSM_CACHE_SIZE = 10000
+
+# Антифлуд: не больше THROTTLE_RATE апдейтов в секунду на игрока, с запасом на короткие серии нажатий
+THROTTLE_RATE = float(os.environ.get('WOG_THROTTLE_RATE', '3'))
+THROTTLE_BURST = int(os.environ.get('WOG_THROTTLE_BURST', '6'))
+
+# Страницы Зала славы общие для всех игроков и пересобираются не чаще раза в RATING_CACHE_TTL секунд
+RATING_CACHE_TTL = int(os.environ.get('WOG_RATING_CACHE_TTL', '30'))
+
+# Сколько последних сообщений помнить, чтобы не отправлять правки, которые ничего не меняют
+EDIT_CACHE_SIZE = int(os.environ.get('WOG_EDIT_CACHE_SIZE', '50000'))
+
+# Анимация бонусного контейнера: full - полный круг спиннера, short - пара кадров, none - сразу результат.
+# Кадры идут через общую очередь отправки; когда анимаций больше лимита, новые показываются без неё.
+BONUS_ANIMATION_MODE = os.environ.get('WOG_BONUS_ANIMATION', 'short')
+BONUS_ANIMATION_FRAMES = {'full': 15, 'short': 3, 'none': 0}
+BONUS_ANIMATION_FRAME_DELAY = 0.15
+BONUS_ANIMATION_CONCURRENCY = int(os.environ.get('WOG_BONUS_ANIMATION_CONCURRENCY', '50'))
+# Необязательные запросы (кадры анимаций) уходят не чаще SEND_QUEUE_RATE в секунду на процесс
+SEND_QUEUE_RATE = float(os.environ.get('WOG_SEND_QUEUE_RATE', '20'))
+SEND_QUEUE_SIZE = 500
+
+# Обучение новичка: первое сообщение сразу, остальные - через столько секунд после регистрации.
+# Очередь лежит в БД и переживает перезапуск; любое действие игрока отменяет оставшиеся шаги.
+ONBOARDING_STEP_DELAYS = {2: 3, 3: 7, 4: 11}
+ONBOARDING_BATCH = 50
+# Досылка спит до ближайшего шага в очереди; раз в столько секунд она всё же сверяется с базой на случай,
+# если шаг поставил другой процесс и не разбудил её
+ONBOARDING_IDLE_CHECK_SECONDS = 60
+
+# Боевые отчеты: текст хранится сжатым, отчеты старше срока хранения удаляются фоновой задачей пачками
+BATTLE_REPORT_RETENTION_DAYS = int(os.environ.get('WOG_BATTLE_REPORT_RETENTION_DAYS', '30'))
+BATTLE_REPORT_PRUNE_BATCH = 1000
+BATTLE_JOURNAL_PAGE_SIZE = 5
+# Отчеты собираются из итогов боя только при просмотре; свежие держим в памяти, их обычно открывают сразу
+BATTLE_REPORT_CACHE_TTL = 300
+BATTLE_REPORT_CACHE_SIZE = 2000
+
+# Рейтинги за день и неделю: счётчики по периодам обновляются в момент боя, границы периодов - по Москве
+LEADERBOARD_PERIODS = ('day', 'week')
+LEADERBOARD_METRICS = ('attack_wins', 'loot', 'defenses_held')
+LEADERBOARD_TIMEZONE = zoneinfo.ZoneInfo('Europe/Moscow')
+LEADERBOARD_RETENTION_DAYS = 14
+
+# Холодное хранилище: игроки без активности дольше срока переезжают в players_archive
+# и возвращаются оттуда при следующем /start
+ARCHIVE_INACTIVE_DAYS = int(os.environ.get('WOG_ARCHIVE_INACTIVE_DAYS', '30'))
+ARCHIVE_BATCH = 500
+
+# Поиск игроков в админ-панели
+ADMIN_SEARCH_PAGE_SIZE = 8
+
+# Журнал изменений ресурсов и армии: обработчики только копят события в памяти,
+# фоновая задача пишет их в базу пачкой раз в LEDGER_FLUSH_INTERVAL секунд или при заполнении пачки
+LEDGER_FLUSH_INTERVAL = float(os.environ.get('WOG_LEDGER_FLUSH_INTERVAL', '0.5'))
+LEDGER_BATCH_SIZE = 500
+LEDGER_RECENT_EVENTS = 10
+
+# Многопроцессный режим: фронтовой процесс получает апдейты и раскладывает их по воркерам по user_id
+WORKER_PROCESSES = int(os.environ.get('WOG_WORKERS', '0'))
+# Фронт раз в WORKER_CHECK_SECONDS проверяет воркеры и перезапускает упавшие. Если за минуту пришлось
+# перезапускать больше WORKER_MAX_RESTARTS_PER_MINUTE раз, фронт останавливается целиком
+WORKER_CHECK_SECONDS = 5
+WORKER_MAX_RESTARTS_PER_MINUTE = 5
+POLLING_TIMEOUT = 30
+# Сколько соединение ждет освобождения блокировки, прежде чем упасть с "database is locked"
+DB_BUSY_TIMEOUT = 10
+
+# Резервные копии онлайн через backup API: по BACKUP_PAGES_PER_STEP страниц за шаг с паузой между шагами,
+# чтобы не забирать весь диск у рабочих запросов. Храним BACKUP_KEEP последних копий (0 в интервале - выключено)
+BACKUP_DIR = os.environ.get('WOG_BACKUP_DIR')
+BACKUP_INTERVAL_HOURS = int(os.environ.get('WOG_BACKUP_INTERVAL_HOURS', '6'))
+BACKUP_KEEP = int(os.environ.get('WOG_BACKUP_KEEP', '7'))
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.01
+# Обслуживание в тихие часы: PRAGMA optimize и incremental vacuum каждую ночь, полный ANALYZE по воскресеньям
+INCREMENTAL_VACUUM_PAGES = 2000
+DB_SIZE_REPORT_SECONDS = 60
+
 if not API_TOKEN:
     raise ValueError("Не найден API_TOKEN. Убедитесь, что он задан в переменных окружения.")
-
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+if WEBHOOK_BASE_URL and not WEBHOOK_SECRET:
+    raise ValueError("Для режима вебхука задайте WOG_WEBHOOK_SECRET.")
+if BONUS_ANIMATION_MODE not in BONUS_ANIMATION_FRAMES:
+    raise ValueError(f"Неизвестный режим анимации бонуса: {BONUS_ANIMATION_MODE}")
+if WEBHOOK_BASE_URL and WORKER_PROCESSES:
+    raise ValueError("Многопроцессный режим пока работает только с long polling.")
+
+if TELEGRAM_API_SERVER:
+    bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)))
+else:
+    bot = Bot(token=API_TOKEN)
+
+
+class GameDispatcher(Dispatcher):
+    # Апдейты, которые отбраковал pre_filter, не доходят даже до middleware aiogram:
+    # для них не строится контекст FSM и не читается состояние из хранилища.
+    # user_flow выстраивает апдейты игрока в очередь тоже до middleware: FSM-состояние читается,
+    # только когда предыдущий апдейт этого игрока полностью обработан
+    pre_filter = None
+    user_flow = None
+
+    async def feed_update(self, bot: Bot, update: types.Update, **kwargs):
+        if self.pre_filter is not None and self.pre_filter(update):
+            return None
+        process = functools.partial(super().feed_update, bot, update, **kwargs)
+        if self.user_flow is None:
+            return await process()
+        return await self.user_flow.run(bot, update, process)
+
+
+dp = GameDispatcher(storage=SQLiteStorage(connect=lambda: db_connect(), state_ttl=FSM_STATE_TTL_SECONDS,
+                                          cache_size=FSM_CACHE_SIZE, clock=lambda: game_clock.time()))
 scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
 
 # --- Определения Юнитов, Зданий и Времени ---
@@ -84,26 +250,331 @@ NPC_LEVELS = {
     9: {'name': 'Крепость "Гидра"', 'army_range': (650, 750), 'resources_range': (60000, 80000)},
     10: {'name': 'Комплекс "Омега"', 'army_range': (900, 1100), 'resources_range': (90000, 120000)},
 }
-MAX_ACTIVE_NPC_CAMPS = 7
+# Лагеря поддерживаются по диапазонам уровней: в каждом держим столько лагерей, сколько нужно активным игрокам
+# с армией этого диапазона (не меньше min и не больше max). Игрок попадает в старший диапазон, до min_army
+# которого доросла его армия. Лагерь, простоявший NPC_CAMP_TTL_HOURS, уходит, побежденные удаляются
+NPC_BANDS = {
+    'low': {'levels': (1, 2, 3), 'weights': (30, 25, 20), 'min_army': 0, 'min': 3, 'max': 40},
+    'mid': {'levels': (4, 5, 6), 'weights': (10, 5, 4), 'min_army': 100, 'min': 2, 'max': 30},
+    'high': {'levels': (7, 8, 9, 10), 'weights': (3, 2, 1, 0.5), 'min_army': 320, 'min': 2, 'max': 20},
+}
+NPC_CAMPS_PER_ACTIVE_PLAYER = 0.5
+NPC_ACTIVE_PLAYER_DAYS = 3
+NPC_CAMP_TTL_HOURS = 24
+NPC_ENGINE_INTERVAL_MINUTES = 15
+
+
+# ==============================================================================
+# --- СОСТОЯНИЕ ИГРОКА ---
+# ==============================================================================
+# Уровни зданий и отряды игрока хранятся в массивах, номер ячейки - позиция здания/юнита в BUILDINGS/UNITS
+BUILDING_IDS = tuple(BUILDINGS)
+UNIT_IDS = tuple(UNITS)
+BUILDING_SLOT = {bld_id: slot for slot, bld_id in enumerate(BUILDING_IDS)}
+UNIT_SLOT = {unit_id: slot for slot, unit_id in enumerate(UNIT_IDS)}
+COMMAND_CENTER, BARRACKS, WAREHOUSE = BUILDING_SLOT['command_center'], BUILDING_SLOT['barracks'], BUILDING_SLOT['warehouse']
+SOLDIER = UNIT_SLOT['soldier']
+
+NEW_PLAYER_BUILDINGS = {'command_center': 1, 'barracks': 1, 'warehouse': 1}
+NEW_PLAYER_ARMY = {'active': {'soldier': 0}, 'reserve': {'soldier': 0}}
+PLAYER_COLUMNS = 'user_id, name, resources, last_update, army, buildings, attack_wins, defense_wins'
+
+
+class PlayerState:
+    # Игрок в памяти: фиксированные поля вместо dict(row) с вложенными словарями из JSON.
+    # В базе army и buildings остаются прежним JSON - на него опираются индексы и выборки по json_extract
+    __slots__ = ('user_id', 'name', 'resources', 'last_update', 'attack_wins', 'defense_wins',
+                 'buildings', 'active', 'reserve', 'unrecorded_production')
+
+    def __init__(self, user_id: int, name: str, resources: float, last_update: int, attack_wins: int,
+                 defense_wins: int, buildings: array.array, active: array.array, reserve: array.array):
+        self.user_id = user_id
+        self.name = name
+        self.resources = resources
+        self.last_update = last_update
+        self.attack_wins = attack_wins
+        self.defense_wins = defense_wins
+        self.buildings = buildings
+        self.active = active
+        self.reserve = reserve
+        # Выработка, насчитанная update_player_resources, но ещё не записанная в журнал
+        self.unrecorded_production = 0.0
+
+    @classmethod
+    def from_row(cls, row) -> 'PlayerState':
+        # Поля строки - в порядке PLAYER_COLUMNS
+        user_id, name, resources, last_update, army_json, buildings_json, attack_wins, defense_wins = row[:8]
+        army, levels = json.loads(army_json), json.loads(buildings_json)
+        active, reserve = army.get('active', {}), army.get('reserve', {})
+        return cls(user_id, name, resources, last_update, attack_wins or 0, defense_wins or 0,
+                   array.array('q', [int(levels.get(bld_id, NEW_PLAYER_BUILDINGS.get(bld_id, 0))) for bld_id in BUILDING_IDS]),
+                   array.array('q', [int(active.get(unit_id, 0)) for unit_id in UNIT_IDS]),
+                   array.array('q', [int(reserve.get(unit_id, 0)) for unit_id in UNIT_IDS]))
+
+    def army_json(self) -> str:
+        return json.dumps({'active': dict(zip(UNIT_IDS, self.active)), 'reserve': dict(zip(UNIT_IDS, self.reserve))})
+
+    def buildings_json(self) -> str:
+        return json.dumps(dict(zip(BUILDING_IDS, self.buildings)))
+
+
+# ==============================================================================
+# --- ЧАСЫ И ГЕНЕРАТОР СЛУЧАЙНЫХ ЧИСЕЛ ---
+# ==============================================================================
+# Все игровые расчеты берут время и удачу отсюда, а не из time/random напрямую:
+# при воспроизведении записанного трафика часы "замораживаются" на моменте апдейта,
+# а генератор засевается от номера апдейта, поэтому повторный прогон дает ту же БД.
+class GameClock:
+    def __init__(self):
+        self.frozen_at = None
+
+    def time(self) -> float:
+        if self.frozen_at is not None:
+            return self.frozen_at
+        return time.time()
+
+    def freeze(self, timestamp: float | None):
+        self.frozen_at = timestamp
+
+
+game_clock = GameClock()
+rng_session_seed = random.SystemRandom().getrandbits(63)
+_update_rng: contextvars.ContextVar[random.Random] = contextvars.ContextVar('update_rng', default=random.Random())
+
+
+def rng() -> random.Random:
+    return _update_rng.get()
+
+
+def seed_rng(*parts):
+    # Отдельный генератор на каждый апдейт/задачу: порядок конкурентных обработчиков на результат не влияет
+    _update_rng.set(random.Random(':'.join(str(part) for part in (rng_session_seed, *parts))))
+
+
+# ==============================================================================
+# --- МЕТРИКИ ---
+# ==============================================================================
+class Histogram:
+    # Скользящее окно последних замеров, перцентили считаются при чтении
+    __slots__ = ('samples', 'count', 'total')
+
+    def __init__(self):
+        self.samples = collections.deque(maxlen=METRICS_SAMPLE_SIZE)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class MetricsRegistry:
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.histograms = collections.defaultdict(Histogram)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        self.histograms[(name, tuple(sorted(labels.items())))].observe(value)
+
+    def counter(self, name: str, **labels) -> float:
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name: str, **labels) -> Histogram | None:
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def label_values(self, name: str, label: str) -> set:
+        return {dict(labels).get(label) for metric, labels in self.counters if metric == name}
+
+    @staticmethod
+    def _format_labels(labels, **extra) -> str:
+        pairs = [*labels, *extra.items()]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def render(self) -> str:
+        # Текстовый формат Prometheus
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            for q in self.QUANTILES:
+                lines.append(f"{name}{self._format_labels(labels, quantile=q)} {histogram.percentile(q):.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.total:.6f}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+class UpdateStats:
+    # Что потратил текущий обработчик: время на БД и Telegram, число запросов и соединений
+    __slots__ = ('db_time', 'api_time', 'queries', 'connections')
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.api_time = 0.0
+        self.queries = 0
+        self.connections = 0
+
+
+_update_stats: contextvars.ContextVar[UpdateStats | None] = contextvars.ContextVar('update_stats', default=None)
 
 
 # ==============================================================================
 # --- УПРАВЛЕНИЕ БАЗОЙ ДАННЫХ ---
 # ==============================================================================
+class QueryProfiler:
+    # Агрегаты по тексту запроса: число вызовов, суммарное и максимальное время (выполнение + выборка)
+    def __init__(self):
+        self.statements = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+    def record(self, sql: str, elapsed: float, executed: bool):
+        entry = self.statements[_normalize_sql(sql)]
+        entry[0] += executed
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+
+    def top(self, limit: int = 10) -> list:
+        return sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+
+
+query_profiler = QueryProfiler()
+EXPLAINABLE_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE', 'WITH')
+
+
+@functools.lru_cache(maxsize=512)
+def _normalize_sql(sql: str) -> str:
+    return ' '.join(sql.split())
+
+
+def _log_slow_query(cursor: sqlite3.Cursor, sql: str, parameters, elapsed: float):
+    plan = ''
+    if _normalize_sql(sql).upper().startswith(EXPLAINABLE_STATEMENTS):
+        try:
+            # Обычный курсор, чтобы EXPLAIN сам не попал в профиль
+            rows = sqlite3.Cursor(cursor.connection).execute('EXPLAIN QUERY PLAN ' + sql, parameters or ()).fetchall()
+            plan = '; '.join(row[-1] for row in rows)
+        except sqlite3.Error as e:
+            plan = f"<нет плана: {e}>"
+    logging.warning(f"Slow query {elapsed * 1000:.1f} ms: {_normalize_sql(sql)} | params={parameters!r} | plan: {plan}")
+
+
+def _profile_query(cursor: sqlite3.Cursor, sql: str | None, parameters, elapsed: float, executed: bool):
+    stats = _update_stats.get()
+    if stats:
+        stats.db_time += elapsed
+        stats.queries += executed
+    if sql is None:
+        return
+    query_profiler.record(sql, elapsed, executed)
+    if elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+        _log_slow_query(cursor, sql, parameters, elapsed)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    statement = None
+    parameters = None
+
+    def execute(self, sql, parameters=()):
+        self.statement, self.parameters = sql, parameters
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _profile_query(self, sql, parameters, time.perf_counter() - started, True)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.statement, self.parameters = sql, None
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _profile_query(self, sql, None, time.perf_counter() - started, True)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _profile_query(self, self.statement, self.parameters, time.perf_counter() - started, False)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _profile_query(self, self.statement, self.parameters, time.perf_counter() - started, False)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def db_connect() -> sqlite3.Connection:
+    # Единая точка подключения к БД: все запросы проходят через инструментированный курсор
+    stats = _update_stats.get()
+    if stats:
+        stats.connections += 1
+    metrics.inc('db_connections_total')
+    return sqlite3.connect(DATABASE_NAME, timeout=DB_BUSY_TIMEOUT, factory=InstrumentedConnection)
+
+
 def init_db():
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
+        # На новой базе включаем инкрементальный vacuum (до первой таблицы); существующую переводит только ручной VACUUM
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL: читатели не блокируют писателя, несколько процессов работают с базой одновременно
+        cursor.execute("PRAGMA journal_mode=WAL")
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS players (
                 user_id INTEGER PRIMARY KEY, name TEXT NOT NULL, resources REAL NOT NULL,
                 last_update INTEGER NOT NULL, army TEXT NOT NULL, buildings TEXT NOT NULL,
                 attack_wins INTEGER DEFAULT 0, defense_wins INTEGER DEFAULT 0 )
         ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS players_archive (
+                user_id INTEGER PRIMARY KEY, name TEXT NOT NULL, resources REAL NOT NULL,
+                last_update INTEGER NOT NULL, army TEXT NOT NULL, buildings TEXT NOT NULL,
+                attack_wins INTEGER DEFAULT 0, defense_wins INTEGER DEFAULT 0, archived_at INTEGER NOT NULL )
+        ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS battle_reports (
                 report_id INTEGER PRIMARY KEY AUTOINCREMENT, player_id INTEGER NOT NULL,
                 report_text TEXT NOT NULL, timestamp INTEGER NOT NULL )
         ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS battles (
+                battle_id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp INTEGER NOT NULL,
+                attacker_id INTEGER NOT NULL, attacker_name TEXT NOT NULL,
+                defender_type TEXT NOT NULL, defender_id INTEGER NOT NULL, defender_name TEXT NOT NULL,
+                luck_modifier REAL NOT NULL, is_attacker_win INTEGER NOT NULL, looted INTEGER NOT NULL,
+                a_initial INTEGER NOT NULL, a_losses INTEGER NOT NULL, d_initial INTEGER NOT NULL, d_losses INTEGER NOT NULL )
+        ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS training_queue (
                 user_id INTEGER PRIMARY KEY, unit_id TEXT NOT NULL,
@@ -135,6 +606,38 @@ def init_db():
                 is_active INTEGER DEFAULT 1
             )
         ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                storage_key TEXT PRIMARY KEY, state TEXT, data TEXT,
+                updated_at INTEGER NOT NULL ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated_at ON fsm_storage (updated_at)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS onboarding_queue (
+                user_id INTEGER NOT NULL, step INTEGER NOT NULL, due_at INTEGER NOT NULL,
+                PRIMARY KEY (user_id, step) ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_onboarding_queue_due_at ON onboarding_queue (due_at)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leaderboard_rollups (
+                period TEXT NOT NULL, period_start INTEGER NOT NULL, user_id INTEGER NOT NULL,
+                attack_wins INTEGER NOT NULL DEFAULT 0, loot INTEGER NOT NULL DEFAULT 0, defenses_held INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (period, period_start, user_id) ) WITHOUT ROWID
+        ''')
+        # Топ периода читается прямо из индекса по нужному показателю
+        for metric in LEADERBOARD_METRICS:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_leaderboard_{metric} ON leaderboard_rollups (period, period_start, {metric})")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ledger (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp INTEGER NOT NULL, user_id INTEGER NOT NULL,
+                event_type TEXT NOT NULL, resources REAL NOT NULL DEFAULT 0,
+                active INTEGER NOT NULL DEFAULT 0, reserve INTEGER NOT NULL DEFAULT 0, ref TEXT )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (user_id, event_id)")
+        # Журнал только дописывается
+        for action in ('UPDATE', 'DELETE'):
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS ledger_no_{action.lower()} BEFORE {action} ON ledger "
+                           f"BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END")
         try:
             cursor.execute("ALTER TABLE players ADD COLUMN attack_wins INTEGER DEFAULT 0")
             cursor.execute("ALTER TABLE players ADD COLUMN defense_wins INTEGER DEFAULT 0")
@@ -142,42 +645,213 @@ def init_db():
         try:
             cursor.execute("ALTER TABLE daily_bonuses ADD COLUMN notification_sent INTEGER DEFAULT 0")
         except sqlite3.OperationalError: pass
+        # Сжатый текст и краткая сводка для журнала; старые строки дожимает prune_battle_reports
+        # Новые отчеты - ссылка на строку battles и сторона, текст собирается только при просмотре
+        for column in ("report_blob BLOB", "opponent_name TEXT", "outcome TEXT", "loot INTEGER DEFAULT 0",
+                       "battle_id INTEGER", "side TEXT"):
+            try:
+                cursor.execute(f"ALTER TABLE battle_reports ADD COLUMN {column}")
+            except sqlite3.OperationalError: pass
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_battle_reports_player_ts ON battle_reports (player_id, timestamp)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_players_last_update ON players (last_update)")
+        # Индексы для поиска в админ-панели: префикс имени и размер армии (выражение должно совпадать с PLAYER_ARMY_SQL)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_players_name ON players (name)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_players_army_size ON players ({PLAYER_ARMY_SQL})")
+        # Дожимать нужно только старые текстовые отчеты: у новых текст не хранится вовсе (battle_id задан)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_battle_reports_uncompressed ON battle_reports (report_id) "
+                       "WHERE report_blob IS NULL AND battle_id IS NULL")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_battles_timestamp ON battles (timestamp)")
+        try:
+            cursor.execute("ALTER TABLE npc_bases ADD COLUMN spawned_at INTEGER")
+        except sqlite3.OperationalError: pass
+        cursor.execute("UPDATE npc_bases SET spawned_at = ? WHERE spawned_at IS NULL", (int(game_clock.time()),))
+        # Активных лагерей единицы на фоне побежденных, поэтому индекс частичный
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_npc_bases_active ON npc_bases (npc_level, spawned_at) WHERE is_active = 1")
+        # Игроки, зарегистрированные до появления журнала, начинают его с текущего состояния
+        cursor.execute('''
+            INSERT INTO ledger (timestamp, user_id, event_type, resources, active, reserve)
+            SELECT ?, user_id, 'opening_balance', resources,
+                   COALESCE(json_extract(army, '$.active.soldier'), 0), COALESCE(json_extract(army, '$.reserve.soldier'), 0)
+            FROM players p WHERE NOT EXISTS (SELECT 1 FROM ledger l WHERE l.user_id = p.user_id)
+        ''', (int(game_clock.time()),))
+        if cursor.rowcount:
+            logging.info(f"Ledger: opening balances written for {cursor.rowcount} players")
         conn.commit()
 
-def get_bonus_cooldown(user_id: int) -> int | None:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+def backup_database(path: str) -> int:
+    # Согласованный снимок без остановки бота. Выполняется в отдельном потоке, пишем во временный файл
+    # и переименовываем, чтобы в каталоге копий никогда не лежал недописанный файл.
+    # Открытая читающая транзакция фиксирует снимок WAL: без неё каждая запись другого соединения
+    # перезапускала бы копирование с нуля, и под нагрузкой оно никогда бы не закончилось
+    partial_path = path + '.part'
+    with db_connect() as src, sqlite3.connect(partial_path) as dst:
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+        # Пауза после каждого шага, чтобы копирование не забирало весь диск у рабочих запросов
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=lambda *_: time.sleep(BACKUP_STEP_PAUSE))
+        src.rollback()
+        page_count = dst.execute("PRAGMA page_count").fetchone()[0]
+    dst.close()
+    os.replace(partial_path, path)
+    return page_count
+
+
+def run_database_maintenance(analyze: bool) -> int:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        if analyze:
+            cursor.execute("ANALYZE")
+        cursor.execute("PRAGMA optimize")
+        cursor.execute("PRAGMA auto_vacuum")
+        if cursor.fetchone()[0] != 2:
+            return 0
+        cursor.execute("PRAGMA freelist_count")
+        free_pages = cursor.fetchone()[0]
+        cursor.execute(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})")
+        cursor.fetchall()
+        conn.commit()
+        return min(free_pages, INCREMENTAL_VACUUM_PAGES)
+
+
+def get_database_sizes() -> dict:
+    sizes = {}
+    for kind, path in (('db', DATABASE_NAME), ('wal', DATABASE_NAME + '-wal')):
+        try:
+            sizes[kind] = os.path.getsize(path)
+        except OSError:
+            sizes[kind] = 0
+    return sizes
+
+
+class CooldownRegistry:
+    # Сроки окончания кулдаунов в памяти. Таблица в базе остаётся источником правды: при первом обращении
+    # из неё разом читаются все действующие кулдауны, дальше set_* пишут в базу и сюда. Отсутствие кулдауна
+    # берётся из памяти (ставит кулдауны только процесс игрока), а найденный кулдаун перепроверяется по базе.
+    # Истёкшие записи вычищает куча по времени окончания, так что в памяти только активные кулдауны.
+    # Как и кэш FSM, согласован, пока апдейты игрока обрабатывает один процесс; без COOLDOWNS_IN_MEMORY
+    # каждая проверка читает строку игрока из базы через lookup.
+    def __init__(self, kind: str, load, lookup):
+        self.kind = kind
+        self.load = load
+        self.lookup = lookup
+        self.expires = {}
+        self.heap = []
+        self.loaded = False
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            for user_id, expires_at in self.load(int(game_clock.time())):
+                self.expires[user_id] = expires_at
+                self.heap.append((expires_at, user_id))
+            heapq.heapify(self.heap)
+            self.loaded = True
+
+    def _expire(self, now: int):
+        heap = self.heap
+        if not heap or heap[0][0] > now:
+            return
+        while heap and heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(heap)
+            # В куче могут остаться устаревшие пары, если кулдаун переназначили раньше срока
+            if self.expires.get(user_id) == expires_at:
+                del self.expires[user_id]
+        metrics.set_gauge('cooldowns_active', len(self.expires), kind=self.kind)
+
+    def get(self, user_id: int) -> Union[int, None]:
+        if not COOLDOWNS_IN_MEMORY:
+            return self.lookup(user_id, int(game_clock.time()))
+        now = int(game_clock.time())
+        self._ensure_loaded()
+        self._expire(now)
+        expires_at = self.expires.get(user_id)
+        if expires_at is not None:
+            # Попадание сверяем с базой: кулдаун мог снять админ массовым сбросом из другого процесса
+            actual = self.lookup(user_id, now)
+            if actual is None:
+                del self.expires[user_id]
+                metrics.set_gauge('cooldowns_active', len(self.expires), kind=self.kind)
+            elif actual != expires_at:
+                self.expires[user_id] = actual
+                heapq.heappush(self.heap, (actual, user_id))
+            expires_at = actual
+        return expires_at
+
+    def set(self, user_id: int, expires_at: int):
+        if not COOLDOWNS_IN_MEMORY:
+            return
+        self._ensure_loaded()
+        self.expires[user_id] = expires_at
+        heapq.heappush(self.heap, (expires_at, user_id))
+        metrics.set_gauge('cooldowns_active', len(self.expires), kind=self.kind)
+
+
+def _load_attack_cooldowns(now: int) -> list:
+    with db_connect() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT last_claim_timestamp FROM daily_bonuses WHERE user_id = ?", (user_id,))
+        cursor.execute("SELECT user_id, finish_time FROM attack_cooldowns WHERE finish_time > ?", (now,))
+        return cursor.fetchall()
+
+
+def _lookup_attack_cooldown(user_id: int, now: int) -> Union[int, None]:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT finish_time FROM attack_cooldowns WHERE user_id = ? AND finish_time > ?", (user_id, now))
         row = cursor.fetchone()
-        if row:
-            time_since_last_claim = int(time.time()) - row[0]
-            if time_since_last_claim < BONUS_COOLDOWN_SECONDS:
-                return BONUS_COOLDOWN_SECONDS - time_since_last_claim
-        return None
+        return row[0] if row else None
+
+
+def _load_bonus_cooldowns(now: int) -> list:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, last_claim_timestamp + ? FROM daily_bonuses WHERE last_claim_timestamp > ?",
+                       (BONUS_COOLDOWN_SECONDS, now - BONUS_COOLDOWN_SECONDS))
+        return cursor.fetchall()
+
+
+def _lookup_bonus_cooldown(user_id: int, now: int) -> Union[int, None]:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT last_claim_timestamp + ? FROM daily_bonuses WHERE user_id = ? AND last_claim_timestamp > ?",
+                       (BONUS_COOLDOWN_SECONDS, user_id, now - BONUS_COOLDOWN_SECONDS))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+
+attack_cooldown_registry = CooldownRegistry('attack', _load_attack_cooldowns, _lookup_attack_cooldown)
+bonus_cooldown_registry = CooldownRegistry('bonus', _load_bonus_cooldowns, _lookup_bonus_cooldown)
+
+
+def get_bonus_cooldown(user_id: int) -> int | None:
+    expires_at = bonus_cooldown_registry.get(user_id)
+    if expires_at:
+        return expires_at - int(game_clock.time())
+    return None
 
 def set_bonus_claimed(user_id: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    now = int(game_clock.time())
+    with db_connect() as conn:
         cursor = conn.cursor()
-        cursor.execute("REPLACE INTO daily_bonuses (user_id, last_claim_timestamp, notification_sent) VALUES (?, ?, 0)", (user_id, int(time.time())))
+        cursor.execute("REPLACE INTO daily_bonuses (user_id, last_claim_timestamp, notification_sent) VALUES (?, ?, 0)", (user_id, now))
         conn.commit()
+    bonus_cooldown_registry.set(user_id, now + BONUS_COOLDOWN_SECONDS)
 
 def get_players_for_bonus_notification() -> list[tuple[int, int]]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, last_claim_timestamp FROM daily_bonuses WHERE notification_sent = 0")
         return cursor.fetchall()
 
 def set_bonus_notification_sent(user_id: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("UPDATE daily_bonuses SET notification_sent = 1 WHERE user_id = ?", (user_id,))
         conn.commit()
 
 def add_player(user_id: int, name: str, army_template: dict, buildings_template: dict):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         player_data = (
-            user_id, name, 1000.0, int(time.time()),
+            user_id, name, 1000.0, int(game_clock.time()),
             json.dumps(army_template), json.dumps(buildings_template),
             0, 0
         )
@@ -185,42 +859,48 @@ def add_player(user_id: int, name: str, army_template: dict, buildings_template:
             INSERT INTO players (user_id, name, resources, last_update, army, buildings, attack_wins, defense_wins)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         ''', player_data)
-        set_bonus_claimed(user_id)
         conn.commit()
+    ledger.record(user_id, 'register', resources=1000.0)
+    set_bonus_claimed(user_id)
 
 
-def get_player(user_id: int) -> Union[dict, None]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM players WHERE user_id = ?", (user_id,))
-        row = cursor.fetchone()
-        if row:
-            player_dict = dict(row)
-            player_dict['army'] = json.loads(player_dict['army'])
-            player_dict['buildings'] = json.loads(player_dict['buildings'])
-            return player_dict
-        return None
+def _fetch_player(cursor: sqlite3.Cursor, user_id: int) -> Union[PlayerState, None]:
+    cursor.execute(f"SELECT {PLAYER_COLUMNS} FROM players WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    return PlayerState.from_row(row) if row else None
 
 
-def update_player_data(user_id: int, data: dict):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        army_json = json.dumps(data.get('army'))
-        buildings_json = json.dumps(data.get('buildings'))
-        cursor.execute('''
-            UPDATE players 
-            SET resources = ?, last_update = ?, army = ?, buildings = ?, 
-            attack_wins = ?, defense_wins = ? WHERE user_id = ?
-        ''', (
-            data.get('resources'), data.get('last_update'), army_json, buildings_json,
-            data.get('attack_wins', 0), data.get('defense_wins', 0), user_id
-        ))
+def _store_player(cursor: sqlite3.Cursor, user_id: int, player: PlayerState, events: list):
+    # Выработку, насчитанную update_player_resources, пишем в журнал только когда она действительно сохраняется:
+    # событие добавляется в events, вызывающий отдает их в ledger после коммита транзакции
+    if player.unrecorded_production:
+        events.append(ledger.event(user_id, 'production', resources=player.unrecorded_production))
+        player.unrecorded_production = 0.0
+    cursor.execute('''
+        UPDATE players 
+        SET resources = ?, last_update = ?, army = ?, buildings = ?, 
+        attack_wins = ?, defense_wins = ? WHERE user_id = ?
+    ''', (
+        player.resources, player.last_update, player.army_json(), player.buildings_json(),
+        player.attack_wins, player.defense_wins, user_id
+    ))
+
+
+def get_player(user_id: int) -> Union[PlayerState, None]:
+    with db_connect() as conn:
+        return _fetch_player(conn.cursor(), user_id)
+
+
+def update_player_data(user_id: int, player: PlayerState, events: Union[list, None] = None):
+    events = list(events or [])
+    with db_connect() as conn:
+        _store_player(conn.cursor(), user_id, player, events)
         conn.commit()
+    ledger.record_events(events)
 
 
 def add_to_training_queue(user_id: int, unit_id: str, quantity: int, next_finish_time: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "REPLACE INTO training_queue (user_id, unit_id, quantity_remaining, next_unit_finish_time) VALUES (?, ?, ?, ?)",
@@ -229,7 +909,7 @@ def add_to_training_queue(user_id: int, unit_id: str, quantity: int, next_finish
 
 
 def get_training_queue(user_id: int) -> Union[tuple, None]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT user_id, unit_id, quantity_remaining, next_unit_finish_time FROM training_queue WHERE user_id = ?",
@@ -238,28 +918,28 @@ def get_training_queue(user_id: int) -> Union[tuple, None]:
 
 
 def remove_from_training_queue(user_id: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM training_queue WHERE user_id = ?", (user_id,))
         conn.commit()
 
 
 def player_exists(user_id: int) -> bool:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT user_id FROM players WHERE user_id = ?", (user_id,))
         return cursor.fetchone() is not None
 
 
 def get_all_user_ids() -> list[int]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT user_id FROM players")
         return [row[0] for row in cursor.fetchall()]
 
 
 def get_top_players(sort_by: str, limit: int = 3) -> list:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         query = f"SELECT name, {sort_by} FROM players ORDER BY {sort_by} DESC LIMIT ?"
         cursor = conn.cursor()
         cursor.execute(query, (limit,))
@@ -267,14 +947,14 @@ def get_top_players(sort_by: str, limit: int = 3) -> list:
 
 
 def get_all_players_for_power_rating() -> list:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT name, army FROM players")
         return cursor.fetchall()
 
 
 def add_to_construction_queue(user_id: int, building_id: str, finish_time: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("INSERT INTO construction_queue (user_id, building_id, finish_time) VALUES (?, ?, ?)",
                        (user_id, building_id, finish_time))
@@ -282,75 +962,437 @@ def add_to_construction_queue(user_id: int, building_id: str, finish_time: int):
 
 
 def get_construction_queue(user_id: int) -> Union[tuple, None]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM construction_queue WHERE user_id = ?", (user_id,))
         return cursor.fetchone()
 
 
 def remove_from_construction_queue(queue_id: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM construction_queue WHERE queue_id = ?", (queue_id,))
         conn.commit()
 
 
-def add_battle_report(player_id: int, report_text: str) -> int:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+def _add_battle_report(cursor: sqlite3.Cursor, player_id: int, battle_id: int, side: str, opponent_name: str,
+                       outcome: str, loot: int, timestamp: int) -> int:
+    # report_text остаётся NOT NULL со старой схемы
+    cursor.execute('''
+        INSERT INTO battle_reports (player_id, report_text, battle_id, side, opponent_name, outcome, loot, timestamp)
+        VALUES (?, '', ?, ?, ?, ?, ?, ?)
+    ''', (player_id, battle_id, side, opponent_name, outcome, loot, timestamp))
+    return cursor.lastrowid
+
+
+def get_battle_report(report_id: int, player_id: int) -> Union[tuple, None]:
+    # (текст, None, None) для старых отчетов и (None, бой, сторона) для новых
+    with db_connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT r.report_text, r.report_blob, r.side, b.*
+            FROM battle_reports r LEFT JOIN battles b ON b.battle_id = r.battle_id
+            WHERE r.report_id = ? AND r.player_id = ?
+        ''', (report_id, player_id))
+        row = cursor.fetchone()
+    if not row:
+        return None
+    if row['battle_id'] is None:
+        text = zlib.decompress(row['report_blob']).decode('utf-8') if row['report_blob'] is not None else row['report_text']
+        return text, None, None
+    return None, {key: row[key] for key in row.keys()[3:]}, row['side']
+
+
+def get_battle_journal(player_id: int, limit: int, offset: int) -> tuple[int, list]:
+    with db_connect() as conn:
         cursor = conn.cursor()
-        timestamp = int(time.time())
-        cursor.execute("INSERT INTO battle_reports (player_id, report_text, timestamp) VALUES (?, ?, ?)",
-                       (player_id, report_text, timestamp))
+        cursor.execute("SELECT COUNT(*) FROM battle_reports WHERE player_id = ?", (player_id,))
+        total = cursor.fetchone()[0]
+        cursor.execute('''
+            SELECT report_id, timestamp, opponent_name, outcome, loot FROM battle_reports
+            WHERE player_id = ? ORDER BY timestamp DESC, report_id DESC LIMIT ? OFFSET ?
+        ''', (player_id, limit, offset))
+        return total, cursor.fetchall()
+
+
+def prune_battle_reports_batch(cutoff: int, limit: int) -> int:
+    # Идём от самых старых по первичному ключу: report_id растёт вместе со временем боя
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM battle_reports WHERE report_id IN (
+                SELECT report_id FROM battle_reports WHERE timestamp < ? ORDER BY report_id LIMIT ?)
+        ''', (cutoff, limit))
+        removed = cursor.rowcount
+        # Строки battles живут столько же, сколько ссылающиеся на них отчеты
+        cursor.execute('''
+            DELETE FROM battles WHERE battle_id IN (
+                SELECT battle_id FROM battles WHERE timestamp < ? ORDER BY battle_id LIMIT ?)
+        ''', (cutoff, limit))
         conn.commit()
-        return cursor.lastrowid
+        return max(removed, cursor.rowcount)
 
 
-def get_battle_report(report_id: int) -> Union[str, None]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+def leaderboard_period_start(period: str, timestamp: float) -> int:
+    start = datetime.datetime.fromtimestamp(timestamp, LEADERBOARD_TIMEZONE).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'week':
+        start -= datetime.timedelta(days=start.weekday())
+    return int(start.timestamp())
+
+
+def _bump_leaderboard_rollups(cursor: sqlite3.Cursor, user_id: int, timestamp: int,
+                              attack_wins: int = 0, loot: int = 0, defenses_held: int = 0):
+    if not (attack_wins or loot or defenses_held):
+        return
+    cursor.executemany('''
+        INSERT INTO leaderboard_rollups (period, period_start, user_id, attack_wins, loot, defenses_held)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (period, period_start, user_id) DO UPDATE SET
+            attack_wins = attack_wins + excluded.attack_wins, loot = loot + excluded.loot,
+            defenses_held = defenses_held + excluded.defenses_held
+    ''', [(period, leaderboard_period_start(period, timestamp), user_id, attack_wins, loot, defenses_held)
+          for period in LEADERBOARD_PERIODS])
+
+
+def get_leaderboard(period: str, metric: str, limit: int = 3) -> list:
+    # metric берётся только из LEADERBOARD_METRICS
+    with db_connect() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT report_text FROM battle_reports WHERE report_id = ?", (report_id,))
-        row = cursor.fetchone()
-        return row[0] if row else None
+        cursor.execute(f'''
+            SELECT p.name, r.{metric} FROM leaderboard_rollups r JOIN players p ON p.user_id = r.user_id
+            WHERE r.period = ? AND r.period_start = ? AND r.{metric} > 0
+            ORDER BY r.{metric} DESC LIMIT ?
+        ''', (period, leaderboard_period_start(period, game_clock.time()), limit))
+        return cursor.fetchall()
+
+
+def prune_leaderboard_rollups(cutoff: int) -> int:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM leaderboard_rollups WHERE period IN (%s) AND period_start < ?"
+                       % ', '.join('?' * len(LEADERBOARD_PERIODS)), (*LEADERBOARD_PERIODS, cutoff))
+        conn.commit()
+        return cursor.rowcount
+
+
+def compress_legacy_battle_reports_batch(limit: int) -> int:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT report_id, report_text FROM battle_reports WHERE report_blob IS NULL AND battle_id IS NULL LIMIT ?",
+                       (limit,))
+        rows = cursor.fetchall()
+        cursor.executemany("UPDATE battle_reports SET report_blob = ?, report_text = '' WHERE report_id = ?",
+                           [(zlib.compress(text.encode('utf-8'), 9), report_id) for report_id, text in rows])
+        conn.commit()
+        return len(rows)
 
 
 def set_attack_cooldown(user_id: int, finish_time: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("REPLACE INTO attack_cooldowns (user_id, finish_time) VALUES (?, ?)", (user_id, finish_time))
         conn.commit()
+    attack_cooldown_registry.set(user_id, finish_time)
 
 
 def get_attack_cooldown(user_id: int) -> Union[int, None]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    return attack_cooldown_registry.get(user_id)
+
+
+class PlayerSnapshot:
+    # Всё, что нужно экранам меню об одном игроке, за одно чтение из базы
+    __slots__ = ('player', 'construction_job', 'training_job', 'attack_cooldown', 'bonus_cooldown')
+
+    def __init__(self, player: PlayerState, construction_job: Union[tuple, None], training_job: Union[tuple, None],
+                 attack_cooldown: Union[int, None], bonus_cooldown: Union[int, None]):
+        self.player = player
+        self.construction_job = construction_job
+        self.training_job = training_job
+        self.attack_cooldown = attack_cooldown
+        self.bonus_cooldown = bonus_cooldown
+
+
+def get_player_snapshot(user_id: int) -> Union[PlayerSnapshot, None]:
+    # Очереди держатся не больше одной строки на игрока, поэтому LEFT JOIN не размножает строку.
+    # Кулдауны берутся из реестров в памяти.
+    with db_connect() as conn:
+        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
-        cursor.execute("SELECT finish_time FROM attack_cooldowns WHERE user_id = ?", (user_id,))
+        cursor.execute('''
+            SELECT p.user_id, p.name, p.resources, p.last_update, p.army, p.buildings,
+                   p.attack_wins, p.defense_wins,
+                   cq.queue_id AS cq_queue_id, cq.building_id AS cq_building_id, cq.finish_time AS cq_finish_time,
+                   tq.unit_id AS tq_unit_id, tq.quantity_remaining AS tq_quantity_remaining,
+                   tq.next_unit_finish_time AS tq_next_unit_finish_time
+            FROM players p
+            LEFT JOIN construction_queue cq ON cq.user_id = p.user_id
+            LEFT JOIN training_queue tq ON tq.user_id = p.user_id
+            WHERE p.user_id = ?
+        ''', (user_id,))
         row = cursor.fetchone()
-        if row and row[0] > int(time.time()):
-            return row[0]
+    if not row:
         return None
+    player = PlayerState.from_row(row)
+    # Кортежи в том же виде, что возвращают get_construction_queue и get_training_queue
+    construction_job = None
+    if row['cq_queue_id'] is not None:
+        construction_job = (row['cq_queue_id'], user_id, row['cq_building_id'], row['cq_finish_time'])
+    training_job = None
+    if row['tq_unit_id'] is not None:
+        training_job = (user_id, row['tq_unit_id'], row['tq_quantity_remaining'], row['tq_next_unit_finish_time'])
+    return PlayerSnapshot(player, construction_job, training_job, get_attack_cooldown(user_id), get_bonus_cooldown(user_id))
+
+def add_onboarding_steps(user_id: int, steps: list[tuple[int, int]]):
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("REPLACE INTO onboarding_queue (user_id, step, due_at) VALUES (?, ?, ?)",
+                           [(user_id, step, due_at) for step, due_at in steps])
+        conn.commit()
+
+
+def remove_onboarding_steps(user_id: int, step: Union[int, None] = None):
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        if step is None:
+            cursor.execute("DELETE FROM onboarding_queue WHERE user_id = ?", (user_id,))
+        else:
+            cursor.execute("DELETE FROM onboarding_queue WHERE user_id = ? AND step = ?", (user_id, step))
+        conn.commit()
+
+
+def get_due_onboarding_steps(now: int, limit: int = ONBOARDING_BATCH) -> list:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, step FROM onboarding_queue WHERE due_at <= ? ORDER BY due_at, user_id, step LIMIT ?",
+                       (now, limit))
+        return cursor.fetchall()
+
 
-def get_active_npc_count() -> int:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+def get_next_onboarding_due() -> Union[int, None]:
+    with db_connect() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(id) FROM npc_bases WHERE is_active = 1")
+        cursor.execute("SELECT MIN(due_at) FROM onboarding_queue")
         return cursor.fetchone()[0]
 
-def spawn_npc_base():
-    with sqlite3.connect(DATABASE_NAME) as conn:
+
+def get_onboarding_finish_times() -> dict:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, MAX(due_at) FROM onboarding_queue GROUP BY user_id")
+        return dict(cursor.fetchall())
+
+
+class OnboardingTracker:
+    # Кто из игроков ещё проходит обучение и когда уйдёт его последний шаг. Поднимается из БД при первом
+    # обращении, дальше проверка на каждом апдейте не ходит в базу. Как и реестр кулдаунов, рассчитан на то,
+    # что апдейты игрока обрабатывает один процесс. Шаги может досылать другой процесс (фронт), поэтому
+    # игроки, чьё обучение уже закончилось по времени, забываются и без сигнала от досылки.
+    PRUNE_EVERY = 1000
+
+    def __init__(self):
+        self.pending = None
+        self.calls = 0
+
+    def _ensure_loaded(self):
+        if self.pending is None:
+            self.pending = get_onboarding_finish_times()
+
+    def start(self, user_id: int, started_at: int):
+        self._ensure_loaded()
+        steps = [(step, started_at + delay) for step, delay in ONBOARDING_STEP_DELAYS.items()]
+        add_onboarding_steps(user_id, steps)
+        self.pending[user_id] = max(due_at for _, due_at in steps)
+        onboarding_scheduler.notify()
+
+    def finish(self, user_id: int):
+        if self.pending is not None:
+            self.pending.pop(user_id, None)
+
+    def cancel(self, user_id: int) -> bool:
+        self._ensure_loaded()
+        now = int(game_clock.time())
+        self.calls += 1
+        if self.calls % self.PRUNE_EVERY == 0:
+            self._prune(now)
+        finish_at = self.pending.pop(user_id, None)
+        if finish_at is None or finish_at < now - ONBOARDING_IDLE_CHECK_SECONDS:
+            return False
+        remove_onboarding_steps(user_id)
+        return True
+
+    def _prune(self, now: int):
+        for user_id in [user_id for user_id, finish_at in self.pending.items()
+                        if finish_at < now - ONBOARDING_IDLE_CHECK_SECONDS]:
+            del self.pending[user_id]
+
+
+onboarding = OnboardingTracker()
+
+def npc_band_of_level(level: int) -> str:
+    return next(band for band, config in NPC_BANDS.items() if level in config['levels'])
+
+
+def get_npc_band_targets(active_since: int) -> dict:
+    # Считаем активных игроков по диапазонам армии одним проходом по индексу last_update
+    thresholds = sorted(((config['min_army'], band) for band, config in NPC_BANDS.items()), reverse=True)
+    band_case = ' '.join(f"WHEN army_size >= {min_army} THEN '{band}'" for min_army, band in thresholds)
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT CASE {band_case} END AS band, COUNT(*) FROM (
+                SELECT {PLAYER_ARMY_SQL} AS army_size FROM players WHERE last_update >= ?)
+            GROUP BY band
+        ''', (active_since,))
+        players_by_band = dict(cursor.fetchall())
+    return {band: min(config['max'], max(config['min'], int(-(-players_by_band.get(band, 0) * NPC_CAMPS_PER_ACTIVE_PLAYER // 1))))
+            for band, config in NPC_BANDS.items()}
+
+
+def run_npc_lifecycle(targets: dict, expire_before: int) -> dict:
+    # Одна транзакция: убираем побежденные и залежавшиеся лагеря, досоздаем недостающие пачкой
+    now = int(game_clock.time())
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("UPDATE npc_bases SET is_active = 0 WHERE is_active = 1 AND spawned_at < ?", (expire_before,))
+        expired = cursor.rowcount
+        cursor.execute("DELETE FROM npc_bases WHERE is_active = 0")
+        purged = cursor.rowcount
+        cursor.execute("SELECT npc_level, COUNT(*) FROM npc_bases WHERE is_active = 1 GROUP BY npc_level")
+        active = collections.Counter()
+        for level, count in cursor.fetchall():
+            active[npc_band_of_level(level)] += count
+        new_camps = []
+        for band, target in targets.items():
+            config = NPC_BANDS[band]
+            for level in rng().choices(config['levels'], weights=config['weights'], k=max(0, target - active[band])):
+                template = NPC_LEVELS[level]
+                new_camps.append((template['name'], level, json.dumps({'soldier': rng().randint(*template['army_range'])}),
+                                  rng().randint(*template['resources_range']), now))
+        cursor.executemany("INSERT INTO npc_bases (name, npc_level, army, resources, spawned_at) VALUES (?, ?, ?, ?, ?)",
+                           new_camps)
+        conn.commit()
+    return {'expired': expired, 'purged': purged, 'spawned': len(new_camps)}
+
+
+def archive_inactive_players_batch(cutoff: int, limit: int) -> int:
+    # Игроков с незавершенной стройкой или тренировкой не трогаем: их очереди живут в горячих таблицах
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute('''
+            SELECT user_id FROM players p WHERE last_update < ?
+              AND NOT EXISTS (SELECT 1 FROM construction_queue cq WHERE cq.user_id = p.user_id)
+              AND NOT EXISTS (SELECT 1 FROM training_queue tq WHERE tq.user_id = p.user_id)
+            ORDER BY last_update LIMIT ?
+        ''', (cutoff, limit))
+        user_ids = [(row[0],) for row in cursor.fetchall()]
+        now = int(game_clock.time())
+        cursor.executemany(f"INSERT OR REPLACE INTO players_archive ({PLAYER_COLUMNS}, archived_at) "
+                           f"SELECT {PLAYER_COLUMNS}, {now} FROM players WHERE user_id = ?", user_ids)
+        cursor.executemany("DELETE FROM players WHERE user_id = ?", user_ids)
+        conn.commit()
+        return len(user_ids)
+
+
+def restore_archived_player(user_id: int) -> bool:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(f"INSERT OR IGNORE INTO players ({PLAYER_COLUMNS}) "
+                       f"SELECT {PLAYER_COLUMNS} FROM players_archive WHERE user_id = ?", (user_id,))
+        restored = cursor.rowcount == 1
+        if restored:
+            cursor.execute("DELETE FROM players_archive WHERE user_id = ?", (user_id,))
+        else:
+            # Живая строка уже есть (или архива нет): архивную не трогаем, чтобы не потерять сохраненное состояние
+            cursor.execute("SELECT 1 FROM players_archive WHERE user_id = ?", (user_id,))
+            if cursor.fetchone():
+                logging.warning(f"Игрок {user_id} есть и в players, и в архиве; архивная запись оставлена")
+        conn.commit()
+        return restored
+
+
+PLAYER_ARMY_SQL = ("(COALESCE(json_extract(army, '$.active.soldier'), 0)"
+                   " + COALESCE(json_extract(army, '$.reserve.soldier'), 0))")
+BULK_ACTIONS = ('resources', 'soldiers', 'cooldowns')
+
+
+def build_player_filter(filters: dict) -> tuple[str, list]:
+    # Каждое условие - диапазон по индексированному столбцу или выражению
+    clauses, params = [], []
+    if filters.get('name'):
+        clauses.append("name >= ? AND name < ?")
+        params += [filters['name'], filters['name'] + chr(0x10FFFF)]
+    unit_power = UNITS['soldier']['stats']['hp'] + UNITS['soldier']['stats']['attack']
+    if filters.get('power_min') is not None:
+        clauses.append(f"{PLAYER_ARMY_SQL} >= ?")
+        params.append(-(-filters['power_min'] // unit_power))
+    if filters.get('power_max') is not None:
+        clauses.append(f"{PLAYER_ARMY_SQL} <= ?")
+        params.append(filters['power_max'] // unit_power)
+    now = int(game_clock.time())
+    if filters.get('idle_days') is not None:
+        clauses.append("last_update < ?")
+        params.append(now - filters['idle_days'] * 86400)
+    if filters.get('active_days') is not None:
+        clauses.append("last_update >= ?")
+        params.append(now - filters['active_days'] * 86400)
+    return (' AND '.join(clauses) or '1'), params
+
+
+def search_players(filters: dict, limit: int, offset: int) -> tuple[int, list]:
+    where, params = build_player_filter(filters)
+    with db_connect() as conn:
         cursor = conn.cursor()
-        level = random.choices(list(NPC_LEVELS.keys()), weights=[30,25,20,10,5,4,3,2,1,0.5], k=1)[0]
-        template = NPC_LEVELS[level]
-        army_size = random.randint(*template['army_range'])
-        resources = random.randint(*template['resources_range'])
-        name = f"{template['name']}"
-        army_json = json.dumps({'soldier': army_size})
-        cursor.execute("INSERT INTO npc_bases (name, npc_level, army, resources) VALUES (?, ?, ?, ?)",
-                       (name, level, army_json, resources))
+        cursor.execute(f"SELECT COUNT(*) FROM players WHERE {where}", params)
+        total = cursor.fetchone()[0]
+        cursor.execute(f'''
+            SELECT user_id, name, {PLAYER_ARMY_SQL}, last_update FROM players
+            WHERE {where} ORDER BY name, user_id LIMIT ? OFFSET ?
+        ''', (*params, limit, offset))
+        return total, cursor.fetchall()
+
+
+def apply_bulk_action(filters: dict, action: str, amount: int, admin_id: int) -> int:
+    # Одна транзакция и по одному UPDATE/INSERT ... SELECT на шаг, без цикла по игрокам.
+    # Сначала фиксируем список игроков: выдача бойцов меняет мощь, по которой мог идти фильтр
+    where, params = build_player_filter(filters)
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("DROP TABLE IF EXISTS temp.bulk_targets")
+        cursor.execute(f"CREATE TEMP TABLE bulk_targets AS SELECT user_id FROM players WHERE {where}", params)
+        cursor.execute("SELECT COUNT(*) FROM temp.bulk_targets")
+        count = cursor.fetchone()[0]
+        targets = "user_id IN (SELECT user_id FROM temp.bulk_targets)"
+        if action == 'resources':
+            cursor.execute(f"UPDATE players SET resources = resources + ? WHERE {targets}", (amount,))
+        elif action == 'soldiers':
+            cursor.execute(f'''
+                UPDATE players SET army = json_set(army, '$.reserve.soldier',
+                                                   COALESCE(json_extract(army, '$.reserve.soldier'), 0) + ?)
+                WHERE {targets}
+            ''', (amount,))
+        elif action == 'cooldowns':
+            cursor.execute(f"DELETE FROM attack_cooldowns WHERE {targets}")
+            cursor.execute(f"DELETE FROM daily_bonuses WHERE {targets}")
+        if action in ('resources', 'soldiers'):
+            # Журнал пишем в той же транзакции, минуя буфер
+            cursor.execute(f'''
+                INSERT INTO ledger (timestamp, user_id, event_type, resources, reserve, ref)
+                SELECT ?, user_id, 'admin_bulk_grant', ?, ?, ? FROM temp.bulk_targets
+            ''', (int(game_clock.time()), amount if action == 'resources' else 0,
+                  amount if action == 'soldiers' else 0, admin_id))
+        cursor.execute("DROP TABLE temp.bulk_targets")
         conn.commit()
-        logging.info(f"Spawned NPC Base: {name} with {army_size} soldiers.")
+    # Реестры кулдаунов сверяют каждое попадание с базой, так что сброс виден всем процессам сразу
+    return count
+
 
 def get_all_targets(user_id_to_exclude: int) -> list:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with db_connect() as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, name, army, buildings FROM players WHERE user_id != ?", (user_id_to_exclude,))
@@ -375,23 +1417,224 @@ def get_all_targets(user_id_to_exclude: int) -> list:
             })
         return sorted(targets, key=lambda t: t['power'])
 
-def get_npc_by_id(npc_id: int) -> dict | None:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+def resolve_battle(attacker_id: int, target_type: str, target_id: int) -> dict | None:
+    # Бой меняет сразу двух участников, которых могут обслуживать разные процессы бота.
+    # Поэтому обоих перечитываем под блокировкой записи (BEGIN IMMEDIATE) и сохраняем одной транзакцией.
+    events = []
+    with db_connect() as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM npc_bases WHERE id = ? AND is_active = 1", (npc_id,))
-        row = cursor.fetchone()
-        if row:
-            npc_dict = dict(row)
-            npc_dict['army'] = json.loads(npc_dict['army'])
-            return npc_dict
-        return None
+        cursor.execute("BEGIN IMMEDIATE")
+        attacker_data = _fetch_player(cursor, attacker_id)
+        if not attacker_data:
+            return None
+        # defender_data есть только у игрока; у лагеря NPC берем имя, армию и ресурсы из его строки
+        defender_data = None
+        if target_type == 'player':
+            defender_data = _fetch_player(cursor, target_id)
+            if not defender_data:
+                return None
+            # Прежнее правило боя: армия защитника-игрока в расчете не участвует
+            d_name, d_resources, d_initial_army = defender_data.name, defender_data.resources, 0
+        elif target_type == 'npc':
+            cursor.execute("SELECT name, army, resources FROM npc_bases WHERE id = ? AND is_active = 1", (target_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            d_name, d_resources, d_initial_army = row['name'], row['resources'], json.loads(row['army']).get('soldier', 0)
+        else:
+            return None
+
+        a_initial_army = attacker_data.active[SOLDIER]
+        if a_initial_army == 0:
+            return None
+        d_active_before = defender_data.active[SOLDIER] if defender_data else 0
+        s_stats = UNITS['soldier']['stats']
+
+        luck_modifier = rng().uniform(-LUCK_MODIFIER_RANGE, LUCK_MODIFIER_RANGE)
+        a_total_damage = a_initial_army * s_stats['attack'] * (1 + luck_modifier)
+        defender_losses = min(d_initial_army, round(a_total_damage / s_stats['hp']))
+        d_survivors = d_initial_army - defender_losses
+        d_total_damage = d_survivors * s_stats['attack']
+        attacker_losses = min(a_initial_army, round(d_total_damage / s_stats['hp']))
+        a_survivors = a_initial_army - attacker_losses
+        is_attacker_win = a_survivors > d_survivors if target_type == 'npc' else attacker_losses < defender_losses
+
+        looted_resources = 0
+        if is_attacker_win:
+            attacker_data.attack_wins += 1
+            if target_type == 'npc':
+                cursor.execute("UPDATE npc_bases SET is_active = 0 WHERE id = ?", (target_id,))
+
+            protected_resources = 0
+            if defender_data:
+                protected_resources = WAREHOUSE_CAPACITY.get(defender_data.buildings[WAREHOUSE], 0) * WAREHOUSE_PROTECTION_PERCENT
+            available_for_looting = max(0, d_resources - protected_resources)
+            cargo_capacity = a_survivors * s_stats['cargo_capacity']
+            looted_resources = min(available_for_looting, cargo_capacity)
 
-def deactivate_npc(npc_id: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+            attacker_data.resources += looted_resources
+            if defender_data:
+                defender_data.resources -= looted_resources
+
+        attacker_data.active[SOLDIER] = a_survivors
+        _store_player(cursor, attacker_id, attacker_data, events)
+
+        if defender_data:
+            defender_data.active[SOLDIER] = d_survivors
+            defender_data.defense_wins += 0 if is_attacker_win else 1
+            _store_player(cursor, target_id, defender_data, events)
+
+        # Итог боя - одна строка цифр; отчеты сторон ссылаются на неё и рендерятся при просмотре
+        battle = {
+            'timestamp': int(game_clock.time()),
+            'attacker_id': attacker_id, 'attacker_name': attacker_data.name,
+            'defender_type': target_type, 'defender_id': target_id, 'defender_name': d_name,
+            'luck_modifier': luck_modifier, 'is_attacker_win': int(is_attacker_win), 'looted': int(looted_resources),
+            'a_initial': a_initial_army, 'a_losses': attacker_losses, 'd_initial': d_initial_army, 'd_losses': defender_losses,
+        }
+        cursor.execute(f"INSERT INTO battles ({', '.join(battle)}) VALUES ({', '.join('?' * len(battle))})",
+                       tuple(battle.values()))
+        battle['battle_id'] = cursor.lastrowid
+        attacker_report_id = _add_battle_report(
+            cursor, attacker_id, battle['battle_id'], 'attacker', d_name,
+            'attack_win' if is_attacker_win else 'attack_loss', battle['looted'], battle['timestamp'])
+        defender_report_id = None
+        if defender_data:
+            defender_report_id = _add_battle_report(
+                cursor, target_id, battle['battle_id'], 'defender', attacker_data.name,
+                'defense_loss' if is_attacker_win else 'defense_win', -battle['looted'], battle['timestamp'])
+            events.append(ledger.event(target_id, 'battle_defense', resources=-looted_resources,
+                                       active=d_survivors - d_active_before, ref=battle['battle_id']))
+            _bump_leaderboard_rollups(cursor, target_id, battle['timestamp'], defenses_held=int(not is_attacker_win))
+        _bump_leaderboard_rollups(cursor, attacker_id, battle['timestamp'],
+                                  attack_wins=int(is_attacker_win), loot=battle['looted'])
+        events.append(ledger.event(attacker_id, 'battle_attack', resources=looted_resources,
+                                   active=a_survivors - a_initial_army, ref=battle['battle_id']))
+        outcome = {
+            'attacker': attacker_data, 'defender': defender_data, 'battle': battle,
+            'attacker_report_id': attacker_report_id, 'defender_report_id': defender_report_id,
+        }
+    ledger.record_events(events)
+    return outcome
+
+# ==============================================================================
+# --- ЖУРНАЛ ИЗМЕНЕНИЙ ---
+# ==============================================================================
+class LedgerWriter:
+    # Все изменения ресурсов и армии игрока пишутся событиями в таблицу ledger; сумма событий игрока
+    # равна его текущим ресурсам и армии. Обработчик только дописывает событие в буфер, в базу буфер
+    # уходит одной транзакцией из фоновой задачи. При падении процесса теряется не больше одного интервала -
+    # такое расхождение покажет сверка /ledger.
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.buffer = []
+        self.wakeup = None
+        self.worker = None
+
+    @staticmethod
+    def event(user_id: int, event_type: str, resources: float = 0, active: int = 0, reserve: int = 0, ref=None) -> tuple:
+        return (int(game_clock.time()), user_id, event_type, resources, active, reserve, None if ref is None else str(ref))
+
+    def record(self, user_id: int, event_type: str, resources: float = 0, active: int = 0, reserve: int = 0, ref=None):
+        self.record_events([self.event(user_id, event_type, resources, active, reserve, ref)])
+
+    def record_events(self, events: list):
+        # События изменений, сохраненных в транзакции, собираются в список и передаются сюда только
+        # после её коммита: иначе откат оставил бы в журнале изменения, которых у игрока нет
+        if not events:
+            return
+        self.buffer.extend(events)
+        if self.worker is None or self.worker.done():
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                # Вне цикла событий (миграции, утилиты) буфер сбрасывают явно
+                return
+            self.wakeup = asyncio.Event()
+            self.worker = start_background_task(self.run())
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        if not self.buffer:
+            return 0
+        batch, self.buffer = self.buffer, []
+        started = time.perf_counter()
+        try:
+            with db_connect() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT INTO ledger (timestamp, user_id, event_type, resources, active, reserve, ref)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', batch)
+                conn.commit()
+        except sqlite3.Error as e:
+            # Вернем пачку в начало буфера и попробуем в следующий раз
+            logging.error(f"Ledger flush of {len(batch)} events failed: {e}")
+            metrics.inc('ledger_flush_errors_total')
+            self.buffer[:0] = batch
+            return 0
+        metrics.inc('ledger_events_total', len(batch))
+        metrics.observe('ledger_flush_seconds', time.perf_counter() - started)
+        metrics.set_gauge('ledger_buffer_length', len(self.buffer))
+        return len(batch)
+
+
+ledger = LedgerWriter(LEDGER_FLUSH_INTERVAL, LEDGER_BATCH_SIZE)
+
+
+def get_ledger_balance(user_id: int) -> tuple:
+    # (число событий, ресурсы, актив, резерв) по журналу
+    with db_connect() as conn:
         cursor = conn.cursor()
-        cursor.execute("UPDATE npc_bases SET is_active = 0 WHERE id = ?", (npc_id,))
-        conn.commit()
+        cursor.execute('''
+            SELECT COUNT(*), COALESCE(SUM(resources), 0), COALESCE(SUM(active), 0), COALESCE(SUM(reserve), 0)
+            FROM ledger WHERE user_id = ?
+        ''', (user_id,))
+        return cursor.fetchone()
+
+
+def get_ledger_events(user_id: int, limit: int) -> list:
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT timestamp, event_type, resources, active, reserve, ref FROM ledger
+            WHERE user_id = ? ORDER BY event_id DESC LIMIT ?
+        ''', (user_id, limit))
+        return cursor.fetchall()
+
+
+def rebuild_player_from_ledger(user_id: int) -> Union[PlayerState, None]:
+    # Ресурсы и армия игрока заменяются суммой его событий в журнале
+    ledger.flush()
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        player_data = _fetch_player(cursor, user_id)
+        if not player_data:
+            return None
+        cursor.execute("SELECT COALESCE(SUM(resources), 0), COALESCE(SUM(active), 0), COALESCE(SUM(reserve), 0) "
+                       "FROM ledger WHERE user_id = ?", (user_id,))
+        resources, active, reserve = cursor.fetchone()
+        player_data.resources = resources
+        player_data.active[SOLDIER] = active
+        player_data.reserve[SOLDIER] = reserve
+        events = []
+        _store_player(cursor, user_id, player_data, events)
+    ledger.record_events(events)
+    return player_data
+
 # ==============================================================================
 # --- FSM (МАШИНА СОСТОЯНИЙ) ---
 # ==============================================================================
@@ -401,6 +1644,9 @@ class AdminStates(StatesGroup):
     waiting_for_amount = State()
     waiting_for_broadcast_message = State()
     waiting_for_player_id_for_info = State()
+    waiting_for_search_query = State()
+    browsing_search_results = State()
+    waiting_for_bulk_amount = State()
 
 
 class TrainingState(StatesGroup):
@@ -422,47 +1668,82 @@ def create_progress_bar(current: float, maximum: float, length: int = 10) -> str
     bar = '█' * filled_length + '░' * (length - filled_length)
     return bar
 
-def update_player_resources(player_data: dict):
-    now = int(time.time())
-    time_passed_seconds = now - player_data.get('last_update', now)
-    cc_level = player_data['buildings'].get('command_center', 0)
-    resources_per_hour = BUILDINGS['command_center']['produces'] * cc_level
+
+def escape_markdown(text: str) -> str:
+    # Имена игроков вставляются в текст с ParseMode.MARKDOWN: служебные символы экранируются, иначе
+    # имя вроде "a_b" ломает разметку всего сообщения
+    return ''.join('\\' + char if char in '_*`[' else char for char in text)
+
+
+class TTLCache:
+    # Небольшой кэш с временем жизни записей по игровым часам; при переполнении вытесняется самая старая запись
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= game_clock.time():
+            del self.entries[key]
+            return None
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (game_clock.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+def update_player_resources(player_data: PlayerState) -> PlayerState:
+    now = int(game_clock.time())
+    time_passed_seconds = now - (player_data.last_update or now)
+    resources_per_hour = BUILDINGS['command_center']['produces'] * player_data.buildings[COMMAND_CENTER]
     gained = (time_passed_seconds / 3600) * resources_per_hour
-    warehouse_level = player_data['buildings'].get('warehouse', 1)
-    capacity = WAREHOUSE_CAPACITY.get(warehouse_level, 0)
-    current_resources = player_data.get('resources', 0)
+    capacity = WAREHOUSE_CAPACITY.get(player_data.buildings[WAREHOUSE], 0)
+    current_resources = player_data.resources
     if current_resources < capacity:
-        player_data['resources'] = min(capacity, current_resources + gained)
-    player_data['last_update'] = now
+        player_data.resources = min(capacity, current_resources + gained)
+        player_data.unrecorded_production += player_data.resources - current_resources
+    player_data.last_update = now
     return player_data
 
-async def check_and_complete_training(user_id: int):
-    training_job = get_training_queue(user_id)
+async def check_and_complete_training(user_id: int, snapshot: Union[PlayerSnapshot, None] = None):
+    # Если передан снимок, работаем с ним и обновляем его на месте, чтобы экран не перечитывал базу
+    training_job = snapshot.training_job if snapshot else get_training_queue(user_id)
     if not training_job:
         return False
-    now = int(time.time())
+    now = int(game_clock.time())
     _, unit_id, quantity_remaining, next_unit_finish_time = training_job
-    player_data = get_player(user_id)
+    player_data = snapshot.player if snapshot else get_player(user_id)
     if not player_data: return False
     player_data = update_player_resources(player_data)
-    barracks_level = player_data['buildings'].get('barracks', 1)
-    time_per_unit = BARRACKS_TRAINING_TIME.get(barracks_level, 999)
+    time_per_unit = BARRACKS_TRAINING_TIME.get(player_data.buildings[BARRACKS], 999)
     units_completed = 0
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        while now >= next_unit_finish_time and quantity_remaining > 0:
-            units_completed += 1
-            quantity_remaining -= 1
-            next_unit_finish_time += time_per_unit
-        if units_completed > 0:
-            player_data['army']['reserve'][unit_id] = player_data['army']['reserve'].get(unit_id, 0) + units_completed
-            update_player_data(user_id, player_data)
+    while now >= next_unit_finish_time and quantity_remaining > 0:
+        units_completed += 1
+        quantity_remaining -= 1
+        next_unit_finish_time += time_per_unit
+    if units_completed > 0:
+        player_data.reserve[UNIT_SLOT[unit_id]] += units_completed
+        events = [ledger.event(user_id, 'training_complete', reserve=units_completed, ref=unit_id)]
+        with db_connect() as conn:
+            cursor = conn.cursor()
+            _store_player(cursor, user_id, player_data, events)
             if quantity_remaining > 0:
                 cursor.execute("UPDATE training_queue SET quantity_remaining = ?, next_unit_finish_time = ? WHERE user_id = ?",
                                (quantity_remaining, next_unit_finish_time, user_id))
             else:
                 cursor.execute("DELETE FROM training_queue WHERE user_id = ?", (user_id,))
             conn.commit()
+        ledger.record_events(events)
+        if snapshot:
+            snapshot.training_job = (user_id, unit_id, quantity_remaining, next_unit_finish_time) if quantity_remaining > 0 else None
     if units_completed > 0 and quantity_remaining == 0:
         try:
             await bot.send_message(user_id, "✅ **Подготовка завершена!** Новые отряды прибыли в резерв.")
@@ -471,104 +1752,937 @@ async def check_and_complete_training(user_id: int):
     return units_completed > 0
 
 
-async def check_and_complete_construction(user_id: int):
-    job = get_construction_queue(user_id)
-    if job and time.time() >= job[3]:
-        queue_id, _, building_id, _ = job
-        if building_id not in BUILDINGS:
-            logging.error(f"Invalid building_id '{building_id}' for user {user_id}. Removing bad entry.")
-            remove_from_construction_queue(queue_id)
-            return False
-        player_data = get_player(user_id)
-        if player_data:
-            player_data['buildings'][building_id] = player_data['buildings'].get(building_id, 0) + 1
-            update_player_data(user_id, player_data)
-        remove_from_construction_queue(queue_id)
-        try:
-            building_name = BUILDINGS[building_id]['name']
-            await bot.send_message(user_id,
-                                   f"✅ **Строительство завершено!**\n{building_name} улучшен до уровня {player_data['buildings'][building_id]}.")
-        except TelegramAPIError as e:
-            logging.error(f"Не удалось уведомить о завершении строительства {user_id}: {e}")
-        return True
-    return False
+async def check_and_complete_construction(user_id: int, snapshot: Union[PlayerSnapshot, None] = None):
+    job = snapshot.construction_job if snapshot else get_construction_queue(user_id)
+    if job and game_clock.time() >= job[3]:
+        queue_id, _, building_id, _ = job
+        if snapshot:
+            snapshot.construction_job = None
+        if building_id not in BUILDINGS:
+            logging.error(f"Invalid building_id '{building_id}' for user {user_id}. Removing bad entry.")
+            remove_from_construction_queue(queue_id)
+            return False
+        player_data = snapshot.player if snapshot else get_player(user_id)
+        events = []
+        with db_connect() as conn:
+            cursor = conn.cursor()
+            if player_data:
+                player_data.buildings[BUILDING_SLOT[building_id]] += 1
+                _store_player(cursor, user_id, player_data, events)
+            cursor.execute("DELETE FROM construction_queue WHERE queue_id = ?", (queue_id,))
+            conn.commit()
+        ledger.record_events(events)
+        try:
+            building_name = BUILDINGS[building_id]['name']
+            await bot.send_message(user_id,
+                                   f"✅ **Строительство завершено!**\n{building_name} улучшен до уровня {player_data.buildings[BUILDING_SLOT[building_id]]}.")
+        except TelegramAPIError as e:
+            logging.error(f"Не удалось уведомить о завершении строительства {user_id}: {e}")
+        return True
+    return False
+
+# Функция для настройки команд меню
+async def set_main_menu(bot: Bot):
+    main_menu_commands = [
+        BotCommand(command=command, description=description)
+        for command, description in LEXICON_COMMANDS_RU.items()
+    ]
+    await bot.set_my_commands(main_menu_commands)
+
+
+# ==============================================================================
+# --- ЗАПИСЬ И ВОСПРОИЗВЕДЕНИЕ АПДЕЙТОВ ---
+# ==============================================================================
+class UpdateRecorder:
+    # Пишет апдейты и запуски фоновых задач в компактный JSONL-лог.
+    # Рядом кладется снимок БД на момент начала записи - с него начинается воспроизведение.
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def start(self, seed: int):
+        with db_connect() as src, sqlite3.connect(self.path + '.db') as dst:
+            src.backup(dst)
+        self.file = open(self.path, 'w', encoding='utf-8', buffering=1)
+        self._write({'kind': 'header', 'seed': seed, 'ts': game_clock.time()})
+        logging.info(f"Recording updates to {self.path} (seed {seed})")
+
+    def record_update(self, update: types.Update, ts: float):
+        self._write({'kind': 'update', 'ts': ts,
+                     'update': update.model_dump(mode='json', exclude_none=True, by_alias=True)})
+
+    def record_job(self, name: str, ts: float):
+        self._write({'kind': 'job', 'name': name, 'ts': ts})
+
+    def _write(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+update_recorder: UpdateRecorder | None = None
+SCHEDULED_JOBS = {}
+
+
+class UpdateRecorderMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: types.Update, data: dict):
+        ts = game_clock.time()
+        seed_rng('update', event.update_id)
+        if update_recorder:
+            update_recorder.record_update(event, ts)
+        return await handler(event, data)
+
+
+class OnboardingCancelMiddleware(BaseMiddleware):
+    # Игрок уже сам нажимает кнопки - оставшиеся сообщения обучения ему не нужны
+    async def __call__(self, handler, event: types.Update, data: dict):
+        user = data.get('event_from_user')
+        if user and onboarding.cancel(user.id):
+            metrics.inc('onboarding_cancelled_total')
+        return await handler(event, data)
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    # Ограничивает число одновременно обрабатываемых апдейтов: лишние ждут в очереди
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event: types.Update, data: dict):
+        async with self.semaphore:
+            return await handler(event, data)
+
+
+class UserFlowState:
+    __slots__ = ('lock', 'tokens', 'refilled_at', 'pending_callbacks', 'active')
+
+    def __init__(self, tokens: float, now: float):
+        self.lock = asyncio.Lock()
+        self.tokens = tokens
+        self.refilled_at = now
+        self.pending_callbacks = {}
+        self.active = 0
+
+
+class UserFlowControl:
+    # Апдейты одного игрока обрабатываются строго по очереди и в порядке поступления.
+    # Сверх лимита (token bucket) апдейты отбрасываются, не доходя ни до FSM-хранилища, ни до БД;
+    # из нескольких одинаковых нажатий, ждущих своей очереди, выполняется только последнее.
+    # Вызывается из GameDispatcher.feed_update, раньше всех middleware aiogram
+    PRUNE_EVERY = 1000
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.users = {}
+        self.calls = 0
+
+    async def run(self, bot: Bot, update: types.Update, process):
+        user_id = get_update_user_id(update)
+        if user_id is None:
+            return await process()
+        now = game_clock.time()
+        self.calls += 1
+        if self.calls % self.PRUNE_EVERY == 0:
+            self._prune(now)
+
+        flow = self.users.get(user_id)
+        if flow is None:
+            flow = self.users[user_id] = UserFlowState(self.burst, now)
+        flow.tokens = min(self.burst, flow.tokens + max(0.0, now - flow.refilled_at) * self.rate)
+        flow.refilled_at = now
+        callback = update.callback_query
+        if flow.tokens < 1:
+            metrics.inc('updates_throttled_total')
+            if callback:
+                await self._answer_quietly(bot, callback, LEXICON_RU['throttled_alert'])
+            return None
+        flow.tokens -= 1
+
+        generation = None
+        if callback:
+            generation = flow.pending_callbacks.get(callback.data, 0) + 1
+            flow.pending_callbacks[callback.data] = generation
+        flow.active += 1
+        try:
+            async with flow.lock:
+                if callback:
+                    if flow.pending_callbacks.get(callback.data) != generation:
+                        metrics.inc('callbacks_coalesced_total')
+                        await self._answer_quietly(bot, callback)
+                        return None
+                    del flow.pending_callbacks[callback.data]
+                return await process()
+        finally:
+            flow.active -= 1
+
+    @staticmethod
+    async def _answer_quietly(bot: Bot, callback: types.CallbackQuery, text: str | None = None):
+        try:
+            await bot.answer_callback_query(callback.id, text=text)
+        except TelegramAPIError:
+            pass
+
+    def _prune(self, now: float):
+        # Забываем игроков без апдейтов в работе, у которых корзина уже наполнилась бы доверху
+        full_after = self.burst / self.rate if self.rate > 0 else 0
+        for user_id in [user_id for user_id, flow in self.users.items()
+                        if not flow.active and now - flow.refilled_at >= full_after]:
+            del self.users[user_id]
+
+
+def recorded_job(func):
+    # Фоновые задачи тоже попадают в лог, чтобы спавн NPC и уведомления воспроизводились в том же порядке
+    @functools.wraps(func)
+    async def wrapper():
+        ts = game_clock.time()
+        seed_rng('job', func.__name__, int(ts))
+        if update_recorder:
+            update_recorder.record_job(func.__name__, ts)
+        await func()
+    SCHEDULED_JOBS[func.__name__] = wrapper
+    return wrapper
+
+
+class ReplaySession(BaseSession):
+    # Сессия-заглушка для воспроизведения: в Telegram ничего не уходит, ответы правдоподобные
+    def __init__(self):
+        super().__init__()
+        self.message_ids = itertools.count(1)
+        self.requests_count = 0
+
+    async def make_request(self, bot: Bot, method, timeout: int | None = None):
+        self.requests_count += 1
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return types.Message(
+                message_id=getattr(method, 'message_id', None) or next(self.message_ids),
+                date=datetime.datetime.fromtimestamp(game_clock.time()),
+                chat=types.Chat(id=method.chat_id, type='private'),
+                text=method.text
+            ).as_(bot)
+        return True
+
+    async def stream_content(self, url: str, headers: dict | None = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True):
+        # Файлы при воспроизведении не скачиваются: обработчик получает пустое содержимое, прогон продолжается
+        logging.warning("Replay: скачивание файла пропущено")
+        yield b''
+
+    async def close(self):
+        pass
+
+
+def describe_update(update: types.Update) -> str:
+    if update.callback_query:
+        return f"callback {update.callback_query.data}"
+    if update.message:
+        return f"message {(update.message.text or '')[:32]!r}"
+    return update.event_type
+
+
+def database_digest() -> str:
+    with db_connect() as conn:
+        digest = hashlib.sha256()
+        for line in conn.iterdump():
+            digest.update(line.encode('utf-8'))
+        return digest.hexdigest()
+
+
+# ==============================================================================
+# --- ФИЛЬТР ГРУППОВЫХ ЧАТОВ ---
+# ==============================================================================
+# В группах бот отвечает только на команды и слово-триггер. Числа пропускаем, потому что их ждут
+# шаги FSM, если меню открыли прямо в группе; сообщения админов не трогаем.
+GROUP_TRIGGER_WORDS = frozenset({'!контейнер'})
+GROUP_TRIGGER_MAX_LENGTH = max(len(word) for word in GROUP_TRIGGER_WORDS)
+
+
+def filter_group_noise(update: types.Update) -> bool:
+    message = update.message
+    if message is None or message.chat.type == 'private':
+        return False
+    text = message.text
+    if text:
+        if text[0] == '/' or text.isdigit():
+            return False
+        if len(text) <= GROUP_TRIGGER_MAX_LENGTH and text.lower() in GROUP_TRIGGER_WORDS:
+            return False
+    if message.from_user and message.from_user.id in ADMIN_IDS:
+        return False
+    metrics.inc('group_updates_dropped_total', kind='text' if text else 'other')
+    return True
+
+
+# ==============================================================================
+# --- СБОР МЕТРИК ОБРАБОТЧИКОВ ---
+# ==============================================================================
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: к этому моменту aiogram уже выбрал обработчик, знаем его имя.
+    # CPU считается по thread_time и при перекрывающихся обработчиках включает и соседей.
+    async def __call__(self, handler, event, data: dict):
+        handler_object = data.get('handler')
+        if 'callback_route' in data:
+            name = data['callback_route'].name
+        else:
+            name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        stats = UpdateStats()
+        token = _update_stats.set(stats)
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc('handler_errors_total', handler=name)
+            raise
+        finally:
+            _update_stats.reset(token)
+            metrics.inc('handler_calls_total', handler=name)
+            metrics.observe('handler_latency_seconds', time.perf_counter() - started, handler=name)
+            metrics.observe('handler_db_seconds', stats.db_time, handler=name)
+            metrics.observe('handler_api_seconds', stats.api_time, handler=name)
+            metrics.observe('handler_cpu_seconds', time.thread_time() - cpu_started, handler=name)
+            metrics.observe('handler_db_queries', stats.queries, handler=name)
+            metrics.observe('handler_db_connections', stats.connections, handler=name)
+
+
+def rendered_content_hash(method) -> bytes:
+    markup = method.reply_markup
+    entities = method.entities
+    parts = (method.text, str(method.parse_mode),
+             markup.model_dump_json(exclude_none=True) if markup is not None else '',
+             '|'.join(entity.model_dump_json(exclude_none=True) for entity in entities) if entities else '')
+    return hashlib.blake2b('\x00'.join(parts).encode(), digest_size=16).digest()
+
+
+class EditDeduplicationMiddleware(BaseRequestMiddleware):
+    # Помним хэш последнего показанного содержимого для каждого сообщения и не шлём правку,
+    # если текст и клавиатура совпадают. Только личные чаты: их апдейты всегда обрабатывает
+    # один процесс, а сообщение в группе могут параллельно править воркеры разных игроков.
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.rendered = collections.OrderedDict()
+
+    def _remember(self, key: tuple, content_hash: bytes):
+        self.rendered[key] = content_hash
+        self.rendered.move_to_end(key)
+        if len(self.rendered) > self.max_size:
+            self.rendered.popitem(last=False)
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if isinstance(method, EditMessageText) and isinstance(method.chat_id, int) and method.chat_id > 0 and method.message_id:
+            key = (method.chat_id, method.message_id)
+            content_hash = rendered_content_hash(method)
+            if self.rendered.get(key) == content_hash:
+                metrics.inc('telegram_edits_skipped_total', reason='cached')
+                return True
+            try:
+                result = await make_request(bot, method)
+            except TelegramBadRequest as e:
+                if 'message is not modified' not in e.message:
+                    self.rendered.pop(key, None)
+                    raise
+                metrics.inc('telegram_edits_skipped_total', reason='not_modified')
+                result = True
+            self._remember(key, content_hash)
+            return result
+        result = await make_request(bot, method)
+        if isinstance(method, SendMessage) and isinstance(result, types.Message) and result.chat.type == 'private':
+            self._remember((result.chat.id, result.message_id), rendered_content_hash(method))
+        elif isinstance(method, (EditMessageReplyMarkup, DeleteMessage)) and isinstance(method.chat_id, int):
+            self.rendered.pop((method.chat_id, method.message_id), None)
+        return result
+
+
+class TelegramApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot: Bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe('telegram_api_seconds', elapsed, method=type(method).__name__)
+            stats = _update_stats.get()
+            if stats:
+                stats.api_time += elapsed
+
+
+def register_session_middlewares(session: BaseSession):
+    # Пропуск правок стоит снаружи: несостоявшийся запрос не попадает в метрики API
+    session.middleware(EditDeduplicationMiddleware(EDIT_CACHE_SIZE))
+    session.middleware(TelegramApiMetricsMiddleware())
+
+
+def format_handler_metrics(limit: int = 15) -> str:
+    handlers = metrics.label_values('handler_calls_total', 'handler')
+    if not handlers:
+        return LEXICON_RU['admin_metrics_empty']
+
+    def total_latency(name):
+        histogram = metrics.histogram('handler_latency_seconds', handler=name)
+        return histogram.total if histogram else 0
+
+    lines = []
+    for name in sorted(handlers, key=total_latency, reverse=True)[:limit]:
+        latency = metrics.histogram('handler_latency_seconds', handler=name)
+        db = metrics.histogram('handler_db_seconds', handler=name)
+        api = metrics.histogram('handler_api_seconds', handler=name)
+        cpu = metrics.histogram('handler_cpu_seconds', handler=name)
+        queries = metrics.histogram('handler_db_queries', handler=name)
+        connections = metrics.histogram('handler_db_connections', handler=name)
+        lines.append(LEXICON_RU['admin_metrics_line'].format(
+            handler=name,
+            calls=int(metrics.counter('handler_calls_total', handler=name)),
+            errors=int(metrics.counter('handler_errors_total', handler=name)),
+            p50=latency.percentile(0.5) * 1000, p95=latency.percentile(0.95) * 1000, p99=latency.percentile(0.99) * 1000,
+            db=db.percentile(0.95) * 1000, api=api.percentile(0.95) * 1000, cpu=cpu.percentile(0.95) * 1000,
+            queries=queries.percentile(0.95), connections=connections.percentile(0.95)
+        ))
+    return '\n'.join(lines)
+
+
+def format_query_profile(limit: int = 10) -> str:
+    top_statements = query_profiler.top(limit)
+    if not top_statements:
+        return LEXICON_RU['admin_sql_profile_empty']
+    lines = []
+    for sql, (calls, total, longest) in top_statements:
+        lines.append(LEXICON_RU['admin_sql_profile_line'].format(
+            sql=sql[:120], calls=calls, total=total * 1000,
+            avg=total * 1000 / calls if calls else 0, max=longest * 1000
+        ))
+    return '\n'.join(lines)
+
+
+async def handle_queries_request(request: web.Request) -> web.Response:
+    lines = [f"{total * 1000:10.1f} ms {calls:8d} calls {longest * 1000:8.1f} ms max  {sql}"
+             for sql, (calls, total, longest) in query_profiler.top(50)]
+    return web.Response(text='\n'.join(lines) + '\n', content_type='text/plain')
+
+
+async def handle_metrics_request(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
+
+async def start_metrics_server(port: int = METRICS_PORT) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics_request)
+    app.router.add_get('/queries', handle_queries_request)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logging.info(f"Metrics endpoint: http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+
+# ==============================================================================
+# --- СТОРОЖ ЦИКЛА СОБЫТИЙ ---
+# ==============================================================================
+class LoopLagWatchdog:
+    # Корутина отмечает пульс и меряет, насколько позже положенного ее разбудили.
+    # Пока цикл заблокирован, корутина работать не может, поэтому стек снимает отдельный поток:
+    # если пульс давно не обновлялся, он берет текущий кадр главного потока - это и есть виновник.
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+
+    async def run(self):
+        self.loop_thread_id = threading.get_ident()
+        threading.Thread(target=self._watch, name='loop-lag-watchdog', daemon=True).start()
+        while True:
+            started = time.monotonic()
+            self.heartbeat = started
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            metrics.observe('event_loop_lag_seconds', lag)
+            if lag >= self.threshold:
+                metrics.inc('event_loop_stalls_total')
+                metrics.inc('event_loop_stall_seconds_total', lag)
+
+    def _watch(self):
+        reported_heartbeat = None
+        while True:
+            time.sleep(self.interval)
+            heartbeat = self.heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.threshold or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame, limit=20)) if frame else '<стек недоступен>'
+            logging.warning(f"Event loop blocked for {blocked_for * 1000:.0f}+ ms, current stack:\n{stack}")
+
+
+loop_watchdog = LoopLagWatchdog(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD)
+background_tasks = set()
+
+
+def _log_background_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Background task {task.get_name()} failed: {task.exception()}", exc_info=task.exception())
+
+
+def start_background_task(coro) -> asyncio.Task:
+    # Держим ссылку на задачу, иначе сборщик мусора может снять ее посреди работы; упавшую задачу логируем
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    task.add_done_callback(_log_background_failure)
+    return task
+
+
+# ==============================================================================
+# --- ОЧЕРЕДЬ ОТПРАВКИ ---
+# ==============================================================================
+class SendQueue:
+    # Запросы, без которых можно обойтись, выполняются по одному с шагом 1/rate.
+    # Если очередь забита, запрос сразу отбрасывается - вызывающий узнаёт об этом по результату False.
+    def __init__(self, rate: float, max_size: int):
+        self.interval = 1 / rate
+        self.max_size = max_size
+        self.queue = collections.deque()
+        self.wakeup = None
+        self.worker = None
+
+    def call(self, factory) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if len(self.queue) >= self.max_size:
+            metrics.inc('send_queue_dropped_total')
+            future.set_result(False)
+            return future
+        self.queue.append((factory, future))
+        if self.worker is None or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = start_background_task(self.run())
+        self.wakeup.set()
+        return future
+
+    async def run(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            factory, future = self.queue.popleft()
+            metrics.set_gauge('send_queue_length', len(self.queue))
+            # Любая ошибка запроса завершает только его: вызывающий получает False, очередь продолжает работу
+            try:
+                result = await factory()
+            except TelegramAPIError as e:
+                logging.warning(f"Send queue request failed: {e}")
+                result = False
+            except Exception as e:
+                logging.error(f"Send queue request crashed: {e}", exc_info=True)
+                result = False
+            if not future.done():
+                future.set_result(result)
+            await asyncio.sleep(self.interval)
+
+
+send_queue = SendQueue(SEND_QUEUE_RATE, SEND_QUEUE_SIZE)
+
+
+# ==============================================================================
+# --- ФОНОВЫЕ ЗАДАЧИ (SCHEDULER) ---
+# ==============================================================================
+@recorded_job
+async def check_bonus_notifications():
+    logging.info("Scheduler job 'check_bonus_notifications' running...")
+    users_to_check = get_players_for_bonus_notification()
+    now = int(game_clock.time())
+    for user_id, last_claim_timestamp in users_to_check:
+        if (now - last_claim_timestamp) >= BONUS_COOLDOWN_SECONDS:
+            try:
+                await bot.send_message(user_id, LEXICON_RU['bonus_notification'], parse_mode=ParseMode.MARKDOWN)
+                set_bonus_notification_sent(user_id)
+                logging.info(f"Sent bonus notification to user {user_id}")
+            except TelegramAPIError as e:
+                if 'bot was blocked by the user' in e.message:
+                    logging.warning(f"User {user_id} has blocked the bot. Cannot send notification.")
+                else:
+                    logging.error(f"Failed to send bonus notification to {user_id}: {e}")
+            await asyncio.sleep(0.1)
+            
+@recorded_job
+async def deliver_onboarding_messages():
+    # Время фиксируем на старте: при воспроизведении задача видит ровно те же шаги
+    now = int(game_clock.time())
+    last_step = max(ONBOARDING_STEP_DELAYS, key=ONBOARDING_STEP_DELAYS.get)
+    while True:
+        batch = get_due_onboarding_steps(now)
+        for user_id, step in batch:
+            try:
+                await bot.send_message(user_id, LEXICON_RU[f'welcome_{step}'], parse_mode=ParseMode.MARKDOWN)
+            except TelegramAPIError as e:
+                logging.warning(f"Не удалось отправить шаг обучения {step} игроку {user_id}: {e}")
+            remove_onboarding_steps(user_id, step)
+            if step == last_step:
+                onboarding.finish(user_id)
+            await asyncio.sleep(0.05)
+        if len(batch) < ONBOARDING_BATCH:
+            break
+
+
+class OnboardingScheduler:
+    # Вместо опроса по таймеру задача спит до ближайшего due_at в очереди. Шаги, поставленные в этом процессе,
+    # будят её через notify; в многопроцессном режиме их ставят воркеры, и фронт будит её сам, переслав /start.
+    # Досылка идёт без перерывов, пока есть созревшие шаги, так что всплеск регистраций не теряет запуски
+    def __init__(self, idle_check: float):
+        self.idle_check = idle_check
+        self.wakeup = None
+        self.worker = None
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.worker = start_background_task(self.run())
+
+    def notify(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            next_due = get_next_onboarding_due()
+            now = game_clock.time()
+            if next_due is not None and next_due <= now:
+                await deliver_onboarding_messages()
+                continue
+            timeout = self.idle_check if next_due is None else min(self.idle_check, next_due - now)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+onboarding_scheduler = OnboardingScheduler(ONBOARDING_IDLE_CHECK_SECONDS)
+
+
+@recorded_job
+async def prune_battle_reports():
+    # Пачками, с передышкой между ними, чтобы не держать блокировку записи и не морозить цикл событий
+    cutoff = int(game_clock.time()) - BATTLE_REPORT_RETENTION_DAYS * 86400
+    removed = compressed = 0
+    while True:
+        batch = prune_battle_reports_batch(cutoff, BATTLE_REPORT_PRUNE_BATCH)
+        removed += batch
+        if batch < BATTLE_REPORT_PRUNE_BATCH:
+            break
+        await asyncio.sleep(0.1)
+    while True:
+        batch = compress_legacy_battle_reports_batch(BATTLE_REPORT_PRUNE_BATCH)
+        compressed += batch
+        if batch < BATTLE_REPORT_PRUNE_BATCH:
+            break
+        await asyncio.sleep(0.1)
+    # Заодно забываем счётчики давно закончившихся периодов рейтинга
+    prune_leaderboard_rollups(int(game_clock.time()) - LEADERBOARD_RETENTION_DAYS * 86400)
+    metrics.inc('battle_reports_pruned_total', removed)
+    logging.info(f"Battle reports: pruned {removed}, compressed {compressed} legacy rows")
+
+
+@recorded_job
+async def archive_inactive_players():
+    # Пачками, как и чистка отчетов: горячая таблица players растёт с числом активных игроков, а не всех когда-либо зашедших
+    cutoff = int(game_clock.time()) - ARCHIVE_INACTIVE_DAYS * 86400
+    archived = 0
+    while True:
+        batch = archive_inactive_players_batch(cutoff, ARCHIVE_BATCH)
+        archived += batch
+        if batch < ARCHIVE_BATCH:
+            break
+        await asyncio.sleep(0.1)
+    metrics.inc('players_archived_total', archived)
+    logging.info(f"Archived {archived} inactive players")
+
+
+async def backup_database_job():
+    # Копии базу не меняют, поэтому в лог апдейтов не пишутся
+    backup_dir = BACKUP_DIR or os.path.join(os.path.dirname(DATABASE_NAME) or '.', 'backups')
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.datetime.fromtimestamp(game_clock.time()).strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(backup_dir, f"wog-{stamp}.db")
+    started = time.perf_counter()
+    try:
+        pages = await asyncio.to_thread(backup_database, path)
+    except (sqlite3.Error, OSError) as e:
+        logging.error(f"Database backup to {path} failed: {e}")
+        metrics.inc('db_backup_errors_total')
+        return
+    elapsed = time.perf_counter() - started
+    metrics.observe('db_backup_seconds', elapsed)
+    metrics.set_gauge('db_backup_last_timestamp', game_clock.time())
+    backups = sorted(name for name in os.listdir(backup_dir) if name.startswith('wog-') and name.endswith('.db'))
+    for name in backups[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        os.remove(os.path.join(backup_dir, name))
+    logging.info(f"Database backup {path}: {pages} pages in {elapsed:.1f}s, keeping {min(len(backups), BACKUP_KEEP)} copies")
+
+
+async def maintain_database():
+    analyze = datetime.datetime.fromtimestamp(game_clock.time(), LEADERBOARD_TIMEZONE).weekday() == 6
+    try:
+        freed = await asyncio.to_thread(run_database_maintenance, analyze)
+    except sqlite3.Error as e:
+        logging.error(f"Database maintenance failed: {e}")
+        return
+    logging.info(f"Database maintenance done (analyze: {analyze}, freed up to {freed} pages)")
+    report_database_size()
+
+
+def report_database_size():
+    for kind, size in get_database_sizes().items():
+        metrics.set_gauge('db_file_size_bytes', size, file=kind)
+
+
+@recorded_job
+async def manage_npc_spawns():
+    now = int(game_clock.time())
+    targets = get_npc_band_targets(now - NPC_ACTIVE_PLAYER_DAYS * 86400)
+    result = run_npc_lifecycle(targets, now - NPC_CAMP_TTL_HOURS * 3600)
+    for band, target in targets.items():
+        metrics.set_gauge('npc_camps_target', target, band=band)
+    metrics.inc('npc_camps_spawned_total', result['spawned'])
+    metrics.inc('npc_camps_expired_total', result['expired'])
+    logging.info(f"NPC camps: targets {targets}, spawned {result['spawned']}, "
+                 f"expired {result['expired']}, purged {result['purged']}")
+
+@recorded_job
+async def purge_stale_fsm_states():
+    removed = dp.storage.purge_expired()
+    if removed:
+        logging.info(f"Removed {removed} stale FSM states.")
+
+# ==============================================================================
+# --- МАРШРУТИЗАЦИЯ CALLBACK-ЗАПРОСОВ ---
+# ==============================================================================
+# Данные кнопок с параметрами упакованы как "префикс:поле:поле". Маршрут ищется по префиксу
+# в словаре, а данные разбираются один раз до вызова обработчика и приходят в него как callback_data.
+# Кнопки без параметров - просто строка-префикс, как и раньше.
+class ViewBuildingCallback(CallbackData, prefix='view_building'):
+    building_id: str
+
+
+class UpgradeBuildingCallback(CallbackData, prefix='upgrade'):
+    building_id: str
+
+
+class TrainingQuantityCallback(CallbackData, prefix='train'):
+    action: str  # add, sub, min, max, confirm
+    amount: int = 0
+
+
+class RatingCallback(CallbackData, prefix='rating'):
+    category: str
+
+
+class TargetsPageCallback(CallbackData, prefix='show_targets_page'):
+    page: int
+
+
+class AttackCallback(CallbackData, prefix='attack'):
+    target_type: str
+    target_id: int
+
+
+class ViewReportCallback(CallbackData, prefix='view_report'):
+    report_id: int
+
+
+class BattleJournalCallback(CallbackData, prefix='battle_journal'):
+    page: int
+
+
+class AdminGiveCallback(CallbackData, prefix='admin_give'):
+    resource: str
+
+
+class AdminSearchPageCallback(CallbackData, prefix='admin_search_page'):
+    page: int
+
+
+class AdminBulkCallback(CallbackData, prefix='admin_bulk'):
+    action: str  # resources, soldiers, cooldowns
+
+
+class AdminDossierCallback(CallbackData, prefix='admin_dossier'):
+    user_id: int
+
+
+class CallbackRoute:
+    __slots__ = ('name', 'handler', 'schema', 'state')
+
+    def __init__(self, handler, schema, state: Union[str, None]):
+        self.name = handler.__name__
+        self.handler = CallableObject(handler)
+        self.schema = schema
+        self.state = state
+
+
+callback_routes: dict[str, CallbackRoute] = {}
 
-# Функция для настройки команд меню
-async def set_main_menu(bot: Bot):
-    main_menu_commands = [
-        BotCommand(command=command, description=description)
-        for command, description in LEXICON_COMMANDS_RU.items()
-    ]
-    await bot.set_my_commands(main_menu_commands)
 
+def callback_route(key: Union[str, type], state: Union[State, None] = None):
+    # key - строка для кнопок без параметров или класс CallbackData; state - состояние FSM, без которого кнопка не работает
+    def decorator(handler):
+        prefix = key if isinstance(key, str) else key.__prefix__
+        if prefix in callback_routes:
+            raise ValueError(f"Маршрут '{prefix}' уже занят обработчиком {callback_routes[prefix].name}")
+        callback_routes[prefix] = CallbackRoute(handler, None if isinstance(key, str) else key,
+                                                state.state if state else None)
+        return handler
+    return decorator
+
+
+def _parse_legacy_training(rest: str) -> TrainingQuantityCallback:
+    action, _, value = rest.partition('_')
+    if action == 'set':
+        return TrainingQuantityCallback(action='max' if value == 'max' else 'min')
+    return TrainingQuantityCallback(action=action, amount=int(value or 0))
+
+
+# Кнопки старого формата "префикс_значение" ещё висят в истории чатов (например, уведомления об атаке)
+LEGACY_CALLBACK_PARSERS = (
+    ('view_building_', lambda rest: ViewBuildingCallback(building_id=rest)),
+    ('upgrade_', lambda rest: UpgradeBuildingCallback(building_id=rest)),
+    ('train_', _parse_legacy_training),
+    ('rating_', lambda rest: RatingCallback(category=rest)),
+    ('show_targets_page_', lambda rest: TargetsPageCallback(page=int(rest))),
+    ('attack_', lambda rest: AttackCallback(target_type=rest.split('_', 1)[0], target_id=int(rest.split('_', 1)[1]))),
+    ('view_report_', lambda rest: ViewReportCallback(report_id=int(rest))),
+    ('admin_give_', lambda rest: AdminGiveCallback(resource=rest)),
+)
+
+
+def resolve_callback(data: str) -> tuple:
+    prefix = data.split(':', 1)[0]
+    route = callback_routes.get(prefix)
+    if route is not None:
+        if route.schema is None:
+            return (route, None) if prefix == data else (None, None)
+        return route, route.schema.unpack(data)
+    for legacy_prefix, parse in LEGACY_CALLBACK_PARSERS:
+        if data.startswith(legacy_prefix):
+            payload = parse(data[len(legacy_prefix):])
+            return callback_routes[payload.__prefix__], payload
+    return None, None
+
+
+class CallbackRouterMiddleware(BaseMiddleware):
+    # Внешний middleware callback_query: находит маршрут и разбирает данные до внутренних middleware,
+    # чтобы метрики видели настоящий обработчик, а не общий диспетчер
+    async def __call__(self, handler, event: types.CallbackQuery, data: dict):
+        try:
+            route, payload = resolve_callback(event.data or '')
+        except (ValueError, TypeError, IndexError) as e:
+            logging.warning(f"Не удалось разобрать callback '{event.data}': {e}")
+            return UNHANDLED
+        if route is None or (route.state is not None and data.get('raw_state') != route.state):
+            return UNHANDLED
+        data['callback_route'] = route
+        data['callback_data'] = payload
+        return await handler(event, data)
 
-# ==============================================================================
-# --- ФОНОВЫЕ ЗАДАЧИ (SCHEDULER) ---
-# ==============================================================================
-async def check_bonus_notifications():
-    logging.info("Scheduler job 'check_bonus_notifications' running...")
-    users_to_check = get_players_for_bonus_notification()
-    now = int(time.time())
-    for user_id, last_claim_timestamp in users_to_check:
-        if (now - last_claim_timestamp) >= BONUS_COOLDOWN_SECONDS:
-            try:
-                await bot.send_message(user_id, LEXICON_RU['bonus_notification'], parse_mode=ParseMode.MARKDOWN)
-                set_bonus_notification_sent(user_id)
-                logging.info(f"Sent bonus notification to user {user_id}")
-            except TelegramAPIError as e:
-                if 'bot was blocked by the user' in e.message:
-                    logging.warning(f"User {user_id} has blocked the bot. Cannot send notification.")
-                else:
-                    logging.error(f"Failed to send bonus notification to {user_id}: {e}")
-            await asyncio.sleep(0.1)
-            
-async def manage_npc_spawns():
-    logging.info("Scheduler job 'manage_npc_spawns' running...")
-    active_npcs = get_active_npc_count()
-    if active_npcs < MAX_ACTIVE_NPC_CAMPS:
-        spawn_npc_base()
 
 # ==============================================================================
 # --- КЛАВИАТУРЫ ---
 # ==============================================================================
+# Неизменяемые клавиатуры собираются один раз и дальше отдаются из кэша
+@functools.cache
 def get_main_menu_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="🏕️ Оперативная сводка", callback_data="show_base")
-    builder.button(text="🎯 Цели для атаки", callback_data="show_targets_page_1")
+    builder.button(text="🎯 Цели для атаки", callback_data=TargetsPageCallback(page=1))
     builder.button(text="🏭 Объекты и стройка", callback_data="show_buildings")
     builder.button(text="🛖 Подготовка войск", callback_data="show_barracks_training")
     builder.button(text="🏆 Зал славы", callback_data="show_rating")
     builder.button(text="🎁 Бонусный контейнер", callback_data="show_bonus_menu")
-    builder.adjust(2, 2, 2)
+    builder.button(text="📜 Журнал боёв", callback_data=BattleJournalCallback(page=1))
+    builder.adjust(2, 2, 2, 1)
     return builder.as_markup()
 
 
-def get_buildings_menu_keyboard(player_buildings: dict):
+def get_buildings_menu_keyboard(player_buildings: array.array):
     builder = InlineKeyboardBuilder()
-    for bld_id, bld_info in BUILDINGS.items():
-        level = player_buildings.get(bld_id, 0)
-        builder.button(text=f"{bld_info['name']} (Ур. {level})", callback_data=f"view_building_{bld_id}")
+    for bld_id, level in zip(BUILDING_IDS, player_buildings):
+        builder.button(text=f"{BUILDINGS[bld_id]['name']} (Ур. {level})", callback_data=ViewBuildingCallback(building_id=bld_id))
     builder.button(text="↩️ Назад в штаб", callback_data="main_menu")
     builder.adjust(1)
     return builder.as_markup()
 
 
+@functools.cache
 def get_admin_main_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="💰 Управление ресурсами", callback_data="admin_resources")
     builder.button(text="👨‍💻 Управление игроками", callback_data="admin_player_management")
     builder.button(text="📢 Глобальные объявления", callback_data="admin_broadcast")
+    builder.button(text="📊 Метрики обработчиков", callback_data="admin_metrics")
+    builder.button(text="🐢 Профиль SQL", callback_data="admin_sql_profile")
     builder.adjust(1)
     return builder.as_markup()
 
 
+@functools.cache
 def get_admin_resources_keyboard():
     builder = InlineKeyboardBuilder()
-    builder.button(text="💰 Припасы", callback_data="admin_give_supplies")
+    builder.button(text="💰 Припасы", callback_data=AdminGiveCallback(resource='supplies'))
+    builder.button(text="↩️ Назад в админ-панель", callback_data="admin_main")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@functools.cache
+def get_admin_player_management_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="ℹ️ Получить досье игрока", callback_data="admin_get_player_info")
+    builder.button(text="🔎 Поиск и массовые операции", callback_data="admin_search")
     builder.button(text="↩️ Назад в админ-панель", callback_data="admin_main")
     builder.adjust(1)
     return builder.as_markup()
 
+
+@functools.cache
+def get_base_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🗂️ Распределение сил", callback_data="manage_army")
+    builder.button(text="↩️ Назад в штаб", callback_data="main_menu")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@functools.cache
+def get_army_management_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="➡️ В резерв", callback_data="move_to_reserve")
+    builder.button(text="⬅️ В штурмовой отряд", callback_data="move_to_active")
+    builder.button(text="↩️ Назад", callback_data="show_base")
+    builder.adjust(2, 1)
+    return builder.as_markup()
+
+
+@functools.cache
+def get_rating_menu_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🎖️ Легендарные полководцы", callback_data=RatingCallback(category='power'))
+    builder.button(text="⚔️ Великие завоеватели", callback_data=RatingCallback(category='attack_wins'))
+    builder.button(text="🛡️ Неприступные крепости", callback_data=RatingCallback(category='defense_wins'))
+    builder.button(text="💰 Военные магнаты", callback_data=RatingCallback(category='resources'))
+    builder.button(text="📅 Итоги дня", callback_data=RatingCallback(category='day'))
+    builder.button(text="🗓️ Итоги недели", callback_data=RatingCallback(category='week'))
+    builder.button(text="↩️ Назад в штаб", callback_data="main_menu")
+    builder.adjust(1, 1, 1, 1, 2, 1)
+    return builder.as_markup()
+
+
+@functools.cache
+def get_back_keyboard(text: str, callback_data: str):
+    # Клавиатура из одной кнопки "назад"; ключ кэша - сама кнопка
+    return InlineKeyboardBuilder().button(text=text, callback_data=callback_data).as_markup()
+
 # ==============================================================================
 # --- ОБРАБОТЧИКИ КОМАНД И ОСНОВНЫЕ МЕНЮ ---
 # ==============================================================================
@@ -577,25 +2691,25 @@ async def cmd_start(message: types.Message, state: FSMContext):
     await state.clear()
     user_id = message.from_user.id
 
-    if not player_exists(user_id):
-        army_template = {'active': {'soldier': 0}, 'reserve': {'soldier': 0}}
-        buildings_template = {'command_center': 1, 'barracks': 1, 'warehouse': 1}
-        add_player(user_id, message.from_user.full_name, army_template, buildings_template)
+    snapshot = get_player_snapshot(user_id)
+    if not snapshot and restore_archived_player(user_id):
+        metrics.inc('players_restored_total')
+        logging.info(f"Restored player {user_id} from archive")
+        snapshot = get_player_snapshot(user_id)
+    if not snapshot:
+        add_player(user_id, message.from_user.full_name, NEW_PLAYER_ARMY, NEW_PLAYER_BUILDINGS)
 
         await message.answer(LEXICON_RU['welcome_1'].format(name=message.from_user.full_name), parse_mode=ParseMode.MARKDOWN)
-        await asyncio.sleep(3)
-        await message.answer(LEXICON_RU['welcome_2'], parse_mode=ParseMode.MARKDOWN)
-        await asyncio.sleep(4)
-        await message.answer(LEXICON_RU['welcome_3'], parse_mode=ParseMode.MARKDOWN)
-        await asyncio.sleep(4)
-        await message.answer(LEXICON_RU['welcome_4'], parse_mode=ParseMode.MARKDOWN)
+        # Остальные задачи обучения досылает deliver_onboarding_messages, меню игрок получает сразу
+        onboarding.start(user_id, int(game_clock.time()))
+        player_data = get_player(user_id)
     
     else:
-        await check_and_complete_construction(user_id)
-        await check_and_complete_training(user_id)
+        await check_and_complete_construction(user_id, snapshot)
+        await check_and_complete_training(user_id, snapshot)
         await message.answer(LEXICON_RU['welcome_back'].format(name=message.from_user.full_name))
+        player_data = snapshot.player
 
-    player_data = get_player(user_id)
     if not player_data:
         logging.error(f"FATAL: Could not get or create player data for user {user_id}")
         return
@@ -636,6 +2750,10 @@ async def process_bonus_claim(source: Union[types.Message, types.CallbackQuery])
             await bot.send_message(user.id, LEXICON_RU['bonus_cooldown'].format(time_left=time_left))
         return
 
+    player_data = get_player(user.id)
+    if not player_data:
+        return
+
     prizes = {
         'resources_S': {'chance': 35, 'type': 'resources', 'amount': 50},
         'soldiers_S': {'chance': 25, 'type': 'soldiers', 'amount': 1},
@@ -649,39 +2767,58 @@ async def process_bonus_claim(source: Union[types.Message, types.CallbackQuery])
     
     prize_list = list(prizes.keys())
     weights = [p['chance'] for p in prizes.values()]
-    chosen_prize_key = random.choices(prize_list, weights=weights, k=1)[0]
+    chosen_prize_key = rng().choices(prize_list, weights=weights, k=1)[0]
     chosen_prize = prizes[chosen_prize_key]
+
+    # Приз начисляется до любых запросов к Telegram: анимация только показывает уже выданный результат
+    prize_text = ""
+    if chosen_prize['type'] == 'resources':
+        player_data.resources += chosen_prize['amount']
+        prize_text = f"**{chosen_prize['amount']}** 💰"
+    elif chosen_prize['type'] == 'soldiers':
+        player_data.reserve[SOLDIER] += chosen_prize['amount']
+        prize_text = f"**{chosen_prize['amount']}** 💂"
+    update_player_data(user.id, player_data, [ledger.event(
+        user.id, 'bonus', resources=chosen_prize['amount'] if chosen_prize['type'] == 'resources' else 0,
+        reserve=chosen_prize['amount'] if chosen_prize['type'] == 'soldiers' else 0, ref=chosen_prize_key)])
+    set_bonus_claimed(user.id)
     
     if isinstance(source, types.Message) and source.chat.type != 'private':
         await source.reply(LEXICON_RU['group_bonus_claim_reply'].format(user_mention=user.mention_html()), parse_mode=ParseMode.HTML)
 
+    mode = BONUS_ANIMATION_MODE
+    if mode != 'none' and len(bonus_animations) >= BONUS_ANIMATION_CONCURRENCY:
+        metrics.inc('bonus_animations_degraded_total')
+        mode = 'none'
+    result_text = LEXICON_RU['bonus_success'].format(prize_text=prize_text)
     try:
-        msg_for_anim = await bot.send_message(user.id, LEXICON_RU['bonus_opening'].format(spinner="⢿"))
-        spinners = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"]
-        for i in range(1, len(spinners) * 2):
-            await asyncio.sleep(0.15)
-            await msg_for_anim.edit_text(LEXICON_RU['bonus_opening'].format(spinner=spinners[i % len(spinners)]))
-        
-        player_data = get_player(user.id)
-        if not player_data:
+        if mode == 'none':
+            await bot.send_message(user.id, result_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_back_keyboard("↩️ Назад в штаб", "main_menu"))
             return
-            
-        prize_text = ""
-        if chosen_prize['type'] == 'resources':
-            player_data['resources'] += chosen_prize['amount']
-            prize_text = f"**{chosen_prize['amount']}** 💰"
-        elif chosen_prize['type'] == 'soldiers':
-            player_data['army']['reserve']['soldier'] = player_data['army']['reserve'].get('soldier', 0) + chosen_prize['amount']
-            prize_text = f"**{chosen_prize['amount']}** 💂"
-        
-        update_player_data(user.id, player_data)
-        set_bonus_claimed(user.id)
+        msg_for_anim = await bot.send_message(user.id, LEXICON_RU['bonus_opening'].format(spinner=BONUS_SPINNERS[0]))
+    except TelegramAPIError as e:
+        logging.warning(f"Could not send bonus result to user {user.id}, likely blocked: {e}")
+        return
+    task = start_background_task(play_bonus_animation(msg_for_anim, BONUS_ANIMATION_FRAMES[mode], result_text))
+    bonus_animations.add(task)
+    task.add_done_callback(bonus_animations.discard)
+
 
-        await msg_for_anim.edit_text(LEXICON_RU['bonus_success'].format(prize_text=prize_text), parse_mode=ParseMode.MARKDOWN,
-                                      reply_markup=InlineKeyboardBuilder().button(text="↩️ Назад в штаб", callback_data="main_menu").as_markup())
+BONUS_SPINNERS = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"]
+bonus_animations = set()
 
+
+async def play_bonus_animation(message: types.Message, frames: int, result_text: str):
+    # Кадры - необязательные правки через общую очередь; итог отправляется напрямую
+    for i in range(1, frames + 1):
+        await asyncio.sleep(BONUS_ANIMATION_FRAME_DELAY)
+        text = LEXICON_RU['bonus_opening'].format(spinner=BONUS_SPINNERS[i % len(BONUS_SPINNERS)])
+        if not await send_queue.call(functools.partial(message.edit_text, text)):
+            break
+    try:
+        await message.edit_text(result_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_back_keyboard("↩️ Назад в штаб", "main_menu"))
     except TelegramAPIError as e:
-        logging.warning(f"Could not send bonus result to user {user.id}, likely blocked: {e}")
+        logging.warning(f"Could not send bonus result to user {message.chat.id}, likely blocked: {e}")
 
 @dp.message(Command("bonus"))
 async def cmd_bonus(message: types.Message):
@@ -691,7 +2828,7 @@ async def cmd_bonus(message: types.Message):
 async def text_cmd_bonus(message: types.Message):
     await process_bonus_claim(message)
 
-@dp.callback_query(F.data == "show_bonus_menu")
+@callback_route("show_bonus_menu")
 async def cq_show_bonus_menu(callback: types.CallbackQuery):
     if callback.message:
         await callback.message.delete()
@@ -709,20 +2846,20 @@ async def cmd_admin(message: types.Message, state: FSMContext):
     await message.answer(LEXICON_RU['admin_panel_title'], reply_markup=get_admin_main_keyboard())
 
 
-@dp.callback_query(F.data == "admin_main")
+@callback_route("admin_main")
 async def cq_admin_main_menu(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.edit_text(LEXICON_RU['admin_panel_title'], reply_markup=get_admin_main_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_resources")
+@callback_route("admin_resources")
 async def cq_admin_resources(callback: types.CallbackQuery):
     await callback.message.edit_text(LEXICON_RU['admin_give_resources_title'], reply_markup=get_admin_resources_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("admin_give_"))
-async def cq_admin_select_target_for_res(callback: types.CallbackQuery, state: FSMContext):
-    await state.update_data(resource_to_give=callback.data.split("_")[2])
+@callback_route(AdminGiveCallback)
+async def cq_admin_select_target_for_res(callback: types.CallbackQuery, state: FSMContext, callback_data: AdminGiveCallback):
+    await state.update_data(resource_to_give=callback_data.resource)
     await callback.message.edit_text(LEXICON_RU['admin_enter_target_id_prompt'])
     await state.set_state(AdminStates.waiting_for_target_id_for_resources)
     await callback.answer()
@@ -754,15 +2891,83 @@ async def process_admin_amount(message: types.Message, state: FSMContext):
         await message.reply(LEXICON_RU['admin_player_not_found'])
         await state.clear()
         return
-    target_player_data['resources'] += amount
-    update_player_data(target_id, target_player_data)
+    target_player_data.resources += amount
+    update_player_data(target_id, target_player_data,
+                       [ledger.event(target_id, 'admin_grant', resources=amount, ref=message.from_user.id)])
     await message.reply(LEXICON_RU['admin_give_success'].format(
-        amount=amount, name=target_player_data['name'], user_id=target_id
-    ), reply_markup=InlineKeyboardBuilder().button(text="↩️ В админ-панель", callback_data="admin_main").as_markup())
+        amount=amount, name=target_player_data.name, user_id=target_id
+    ), reply_markup=get_back_keyboard("↩️ В админ-панель", "admin_main"))
     await state.clear()
 
 
-@dp.callback_query(F.data == "admin_broadcast")
+@callback_route("admin_metrics")
+async def cq_admin_metrics(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    lag = metrics.histogram('event_loop_lag_seconds')
+    text = LEXICON_RU['admin_metrics_title'] + '\n\n'
+    if lag:
+        text += LEXICON_RU['admin_metrics_loop_lag'].format(
+            p50=lag.percentile(0.5) * 1000, p95=lag.percentile(0.95) * 1000, p99=lag.percentile(0.99) * 1000,
+            stalls=int(metrics.counter('event_loop_stalls_total'))
+        ) + '\n\n'
+    text += format_handler_metrics()
+    await callback.message.edit_text(text, parse_mode=ParseMode.MARKDOWN,
+                                     reply_markup=get_back_keyboard("↩️ Назад в админ-панель", "admin_main"))
+    await callback.answer()
+
+
+@callback_route("admin_sql_profile")
+async def cq_admin_sql_profile(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    text = LEXICON_RU['admin_sql_profile_title'].format(threshold=SLOW_QUERY_THRESHOLD_MS) + '\n\n' + format_query_profile()
+    await callback.message.edit_text(text, parse_mode=ParseMode.MARKDOWN,
+                                     reply_markup=get_back_keyboard("↩️ Назад в админ-панель", "admin_main"))
+    await callback.answer()
+
+
+@dp.message(Command("ledger"))
+async def cmd_admin_ledger(message: types.Message, command: CommandObject):
+    # /ledger <ID> - сверка состояния игрока с журналом, /ledger <ID> rebuild - восстановление по журналу
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = (command.args or '').split()
+    if not args or not args[0].isdigit() or args[1:] not in ([], ['rebuild']):
+        await message.reply(LEXICON_RU['admin_ledger_usage'], parse_mode=ParseMode.MARKDOWN)
+        return
+    target_id = int(args[0])
+    if args[1:] == ['rebuild']:
+        if not rebuild_player_from_ledger(target_id):
+            await message.reply(LEXICON_RU['admin_player_not_found'])
+            return
+        logging.warning(f"Admin {message.from_user.id} rebuilt player {target_id} from ledger")
+        await message.reply(LEXICON_RU['admin_ledger_rebuilt'])
+    ledger.flush()
+    player_data = get_player(target_id)
+    if not player_data:
+        await message.reply(LEXICON_RU['admin_player_not_found'])
+        return
+    events, resources, active, reserve = get_ledger_balance(target_id)
+    actual_active, actual_reserve = player_data.active[SOLDIER], player_data.reserve[SOLDIER]
+    matches = abs(resources - player_data.resources) < 0.01 and active == actual_active and reserve == actual_reserve
+    text = LEXICON_RU['admin_ledger_report'].format(
+        name=player_data.name, user_id=target_id, events=events,
+        ledger_resources=round(resources, 2), ledger_active=active, ledger_reserve=reserve,
+        resources=round(player_data.resources, 2), active=actual_active, reserve=actual_reserve,
+        verdict=LEXICON_RU['admin_ledger_ok' if matches else 'admin_ledger_mismatch'])
+    recent = get_ledger_events(target_id, LEDGER_RECENT_EVENTS)
+    if recent:
+        text += '\n\n' + LEXICON_RU['admin_ledger_recent_title']
+    for timestamp, event_type, d_resources, d_active, d_reserve, ref in recent:
+        deltas = ' '.join(f"{label}{value:+g}" for label, value in (('💰', round(d_resources, 2)), ('⚔️', d_active), ('🛡️', d_reserve)) if value)
+        text += '\n' + LEXICON_RU['admin_ledger_event_line'].format(
+            datetime=datetime.datetime.fromtimestamp(timestamp).strftime('%d.%m %H:%M:%S'),
+            event_type=event_type, deltas=deltas or '0', ref=f"`{ref}`" if ref else '')
+    await message.answer(text, parse_mode=ParseMode.MARKDOWN)
+
+
+@callback_route("admin_broadcast")
 async def cq_admin_broadcast(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(AdminStates.waiting_for_broadcast_message)
     await callback.message.edit_text(LEXICON_RU['admin_broadcast_prompt'])
@@ -784,20 +2989,16 @@ async def process_broadcast_message(message: types.Message, state: FSMContext):
         await asyncio.sleep(0.1)
     await message.answer(LEXICON_RU['admin_broadcast_success'].format(
         success_count=success_count, fail_count=len(user_ids) - success_count
-    ), reply_markup=InlineKeyboardBuilder().button(text="↩️ В админ-панель", callback_data="admin_main").as_markup())
+    ), reply_markup=get_back_keyboard("↩️ В админ-панель", "admin_main"))
 
 
-@dp.callback_query(F.data == "admin_player_management")
+@callback_route("admin_player_management")
 async def cq_admin_player_management(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    builder = InlineKeyboardBuilder()
-    builder.button(text="ℹ️ Получить досье игрока", callback_data="admin_get_player_info")
-    builder.button(text="↩️ Назад в админ-панель", callback_data="admin_main")
-    builder.adjust(1)
-    await callback.message.edit_text(LEXICON_RU['admin_player_management_title'], reply_markup=builder.as_markup())
+    await callback.message.edit_text(LEXICON_RU['admin_player_management_title'], reply_markup=get_admin_player_management_keyboard())
 
 
-@dp.callback_query(F.data == "admin_get_player_info")
+@callback_route("admin_get_player_info")
 async def cq_admin_get_player_info(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(AdminStates.waiting_for_player_id_for_info)
     await callback.message.edit_text(LEXICON_RU['admin_enter_player_id_for_info'])
@@ -811,118 +3012,263 @@ async def process_player_id_for_info(message: types.Message, state: FSMContext):
         await message.reply(LEXICON_RU['error_positive_number_required'])
         return
     
-    target_id = int(message.text)
-    player_data = get_player(target_id)
-    if not player_data:
+    snapshot = get_player_snapshot(int(message.text))
+    if not snapshot:
         await message.reply(LEXICON_RU['admin_player_not_found'])
         return
+    await message.answer(render_player_dossier(snapshot), parse_mode=ParseMode.MARKDOWN,
+                         reply_markup=get_back_keyboard("↩️ В админ-панель", "admin_main"))
+
+
+def render_player_dossier(snapshot: PlayerSnapshot) -> str:
+    player_data = snapshot.player
+    target_id = player_data.user_id
     
-    dossier_text = LEXICON_RU['admin_player_dossier_title'].format(name=player_data['name'], user_id=target_id)
-    dossier_text += f"\n\n**Ресурсы:** {int(player_data['resources'])} 💰\n\n"
-    dossier_text += LEXICON_RU['dossier_stats'].format(attack_wins=player_data['attack_wins'], defense_wins=player_data['defense_wins']) + '\n\n'
+    dossier_text = LEXICON_RU['admin_player_dossier_title'].format(name=player_data.name, user_id=target_id)
+    dossier_text += f"\n\n**Ресурсы:** {int(player_data.resources)} 💰\n\n"
+    dossier_text += LEXICON_RU['dossier_stats'].format(attack_wins=player_data.attack_wins, defense_wins=player_data.defense_wins) + '\n\n'
     
-    buildings = player_data['buildings']
+    buildings = player_data.buildings
     dossier_text += LEXICON_RU['dossier_buildings'].format(
-        cc_level=buildings.get('command_center', 0),
-        barracks_level=buildings.get('barracks', 0),
-        warehouse_level=buildings.get('warehouse', 0)
+        cc_level=buildings[COMMAND_CENTER],
+        barracks_level=buildings[BARRACKS],
+        warehouse_level=buildings[WAREHOUSE]
     ) + '\n\n'
     
-    army = player_data['army']
     dossier_text += LEXICON_RU['dossier_army'].format(
-        active_army=army.get('active', {}).get('soldier', 0),
-        reserve_army=army.get('reserve', {}).get('soldier', 0)
+        active_army=player_data.active[SOLDIER],
+        reserve_army=player_data.reserve[SOLDIER]
     ) + '\n\n'
     
     processes_text = ""
-    construction_job = get_construction_queue(target_id)
+    construction_job = snapshot.construction_job
     if construction_job:
         _, _, bld_id, finish_time = construction_job
-        time_left = str(datetime.timedelta(seconds=max(0, int(finish_time - time.time()))))
+        time_left = str(datetime.timedelta(seconds=max(0, int(finish_time - game_clock.time()))))
         processes_text += '\n' + LEXICON_RU['dossier_process_construction'].format(
             building_name=BUILDINGS[bld_id]['name'],
-            level=player_data['buildings'].get(bld_id, 0) + 1,
+            level=player_data.buildings[BUILDING_SLOT[bld_id]] + 1,
             time_left=time_left
         )
         
-    training_job = get_training_queue(target_id)
+    training_job = snapshot.training_job
     if training_job:
         _, unit_id, quantity, next_finish_time = training_job
-        time_left = str(datetime.timedelta(seconds=max(0, int(next_finish_time - time.time()))))
+        time_left = str(datetime.timedelta(seconds=max(0, int(next_finish_time - game_clock.time()))))
         processes_text += '\n' + LEXICON_RU['dossier_process_training'].format(
             unit_name=UNITS[unit_id]['name'],
             quantity=quantity,
             time_left=time_left
         )
         
-    cooldown_finish_time = get_attack_cooldown(target_id)
+    cooldown_finish_time = snapshot.attack_cooldown
     if cooldown_finish_time:
-        time_left = str(datetime.timedelta(seconds=max(0, int(cooldown_finish_time - time.time()))))
+        time_left = str(datetime.timedelta(seconds=max(0, int(cooldown_finish_time - game_clock.time()))))
         processes_text += '\n' + LEXICON_RU['dossier_process_attack_cooldown'].format(time_left=time_left)
 
     if processes_text:
         dossier_text += LEXICON_RU['dossier_processes'] + processes_text
     else:
         dossier_text += LEXICON_RU['dossier_no_processes']
-        
-    await message.answer(dossier_text, parse_mode=ParseMode.MARKDOWN,
-                         reply_markup=InlineKeyboardBuilder().button(text="↩️ В админ-панель", callback_data="admin_main").as_markup())
+    return dossier_text
+
+
+@callback_route(AdminDossierCallback)
+async def cq_admin_dossier(callback: types.CallbackQuery, callback_data: AdminDossierCallback):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    snapshot = get_player_snapshot(callback_data.user_id)
+    if not snapshot:
+        await callback.answer(LEXICON_RU['admin_player_not_found'], show_alert=True)
+        return
+    await callback.message.answer(render_player_dossier(snapshot), parse_mode=ParseMode.MARKDOWN)
+    await callback.answer()
+
+
+@callback_route("admin_search")
+async def cq_admin_search(callback: types.CallbackQuery, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    await state.set_state(AdminStates.waiting_for_search_query)
+    await callback.message.edit_text(LEXICON_RU['admin_search_prompt'], parse_mode=ParseMode.MARKDOWN)
+    await callback.answer()
+
+
+def parse_player_search_query(query: str) -> Union[dict, None]:
+    # all | power:100-500 | idle:7 | active:3 | начало имени; условия можно сочетать через пробел.
+    # Выборка по всем игрокам - только по явному all: на её результат работают массовые действия
+    filters, name_parts, match_all = {}, [], False
+    for token in query.split():
+        key, _, value = token.partition(':')
+        key = key.lower()
+        try:
+            if key == 'power':
+                low, _, high = value.partition('-')
+                if not low and not high:
+                    return None
+                filters['power_min'] = int(low) if low else None
+                filters['power_max'] = int(high) if high else None
+            elif key == 'idle':
+                filters['idle_days'] = int(value)
+            elif key == 'active':
+                filters['active_days'] = int(value)
+            elif token.lower() in ('all', '*'):
+                match_all = True
+            else:
+                name_parts.append(token)
+        except ValueError:
+            return None
+    if name_parts:
+        filters['name'] = ' '.join(name_parts)
+    if not filters and not match_all:
+        return None
+    return filters
+
+
+async def show_player_search_page(message: types.Message, state: FSMContext, page: int, edit: bool):
+    state_data = await state.get_data()
+    filters = state_data.get('search_filters', {})
+    total, rows = search_players(filters, ADMIN_SEARCH_PAGE_SIZE, (page - 1) * ADMIN_SEARCH_PAGE_SIZE)
+    total_pages = max(1, (total + ADMIN_SEARCH_PAGE_SIZE - 1) // ADMIN_SEARCH_PAGE_SIZE)
+    unit_power = UNITS['soldier']['stats']['hp'] + UNITS['soldier']['stats']['attack']
+    # Запрос стоит внутри `...`, где экранирование не работает, поэтому обратные кавычки просто заменяем
+    query = (state_data.get('search_query') or 'all').replace('`', "'")
+    text = LEXICON_RU['admin_search_title'].format(query=query, total=total,
+                                                   current_page=page, total_pages=total_pages)
+    builder = InlineKeyboardBuilder()
+    if not rows:
+        text += '\n' + LEXICON_RU['admin_search_empty']
+    for index, (user_id, name, army_size, last_update) in enumerate(rows, start=(page - 1) * ADMIN_SEARCH_PAGE_SIZE + 1):
+        text += '\n' + LEXICON_RU['admin_search_line'].format(
+            index=index, name=escape_markdown(name), user_id=user_id, power=army_size * unit_power,
+            last_seen=datetime.datetime.fromtimestamp(last_update).strftime('%d.%m.%Y'))
+        builder.button(text=f"👤 {index}", callback_data=AdminDossierCallback(user_id=user_id))
+    builder.adjust(4)
+    nav_row = []
+    if page > 1:
+        nav_row.append(types.InlineKeyboardButton(text="◀️ Пред.", callback_data=AdminSearchPageCallback(page=page - 1).pack()))
+    if page < total_pages:
+        nav_row.append(types.InlineKeyboardButton(text="След. ▶️", callback_data=AdminSearchPageCallback(page=page + 1).pack()))
+    if nav_row:
+        builder.row(*nav_row)
+    if total:
+        builder.row(types.InlineKeyboardButton(text="💰 Выдать припасы", callback_data=AdminBulkCallback(action='resources').pack()),
+                    types.InlineKeyboardButton(text="💂 Выдать бойцов", callback_data=AdminBulkCallback(action='soldiers').pack()))
+        builder.row(types.InlineKeyboardButton(text="⏱️ Сбросить кулдауны", callback_data=AdminBulkCallback(action='cooldowns').pack()))
+    builder.row(types.InlineKeyboardButton(text="🔎 Новый поиск", callback_data="admin_search"),
+                types.InlineKeyboardButton(text="↩️ В админ-панель", callback_data="admin_main"))
+    if edit:
+        await message.edit_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=builder.as_markup())
+    else:
+        await message.answer(text, parse_mode=ParseMode.MARKDOWN, reply_markup=builder.as_markup())
+
+
+@dp.message(AdminStates.waiting_for_search_query)
+async def process_player_search_query(message: types.Message, state: FSMContext):
+    filters = parse_player_search_query(message.text) if message.text else None
+    if filters is None:
+        await message.reply(LEXICON_RU['admin_search_bad_query'], parse_mode=ParseMode.MARKDOWN)
+        return
+    await state.set_state(AdminStates.browsing_search_results)
+    await state.update_data(search_filters=filters, search_query=message.text.strip())
+    await show_player_search_page(message, state, 1, edit=False)
+
+
+@callback_route(AdminSearchPageCallback, state=AdminStates.browsing_search_results)
+async def cq_admin_search_page(callback: types.CallbackQuery, state: FSMContext, callback_data: AdminSearchPageCallback):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    await show_player_search_page(callback.message, state, max(1, callback_data.page), edit=True)
+    await callback.answer()
+
+
+@callback_route(AdminBulkCallback, state=AdminStates.browsing_search_results)
+async def cq_admin_bulk_action(callback: types.CallbackQuery, state: FSMContext, callback_data: AdminBulkCallback):
+    if callback.from_user.id not in ADMIN_IDS or callback_data.action not in BULK_ACTIONS:
+        return
+    if callback_data.action == 'cooldowns':
+        state_data = await state.get_data()
+        count = apply_bulk_action(state_data.get('search_filters', {}), 'cooldowns', 0, callback.from_user.id)
+        logging.warning(f"Admin {callback.from_user.id} reset cooldowns for {count} players ({state_data.get('search_query')})")
+        await callback.answer(LEXICON_RU['admin_bulk_cooldowns_done'].format(count=count), show_alert=True)
+        return
+    await state.update_data(bulk_action=callback_data.action)
+    await state.set_state(AdminStates.waiting_for_bulk_amount)
+    await callback.message.answer(LEXICON_RU[f'admin_bulk_{callback_data.action}_prompt'])
+    await callback.answer()
+
+
+@dp.message(AdminStates.waiting_for_bulk_amount)
+async def process_admin_bulk_amount(message: types.Message, state: FSMContext):
+    try:
+        amount = int(message.text)
+    except (TypeError, ValueError):
+        await message.reply("Количество должно быть числом.")
+        return
+    state_data = await state.get_data()
+    action = state_data.get('bulk_action')
+    count = apply_bulk_action(state_data.get('search_filters', {}), action, amount, message.from_user.id)
+    logging.warning(f"Admin {message.from_user.id} bulk {action} {amount:+d} for {count} players ({state_data.get('search_query')})")
+    await state.set_state(AdminStates.browsing_search_results)
+    await message.reply(LEXICON_RU['admin_bulk_done'].format(amount=amount, unit='💰' if action == 'resources' else '💂', count=count))
+    await show_player_search_page(message, state, 1, edit=False)
 
 
 # ==============================================================================
 # --- ОСНОВНЫЕ ИГРОВЫЕ ОБРАБОТЧИКИ ---
 # ==============================================================================
-@dp.callback_query(F.data == "main_menu")
+@callback_route("main_menu")
 async def cq_main_menu(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    await check_and_complete_construction(callback.from_user.id)
-    await check_and_complete_training(callback.from_user.id)
+    snapshot = get_player_snapshot(callback.from_user.id)
+    if snapshot:
+        await check_and_complete_construction(callback.from_user.id, snapshot)
+        await check_and_complete_training(callback.from_user.id, snapshot)
     try:
         await callback.message.edit_text(LEXICON_RU['main_menu_text'], reply_markup=get_main_menu_keyboard())
     except TelegramAPIError:
         await callback.message.answer(LEXICON_RU['main_menu_text'], reply_markup=get_main_menu_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data == "show_base")
+@callback_route("show_base")
 async def cq_show_base(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     user_id = callback.from_user.id
-    await check_and_complete_construction(user_id)
-    await check_and_complete_training(user_id)
-    player_data = get_player(user_id)
-    if not player_data:
+    snapshot = get_player_snapshot(user_id)
+    if not snapshot:
         await callback.answer(LEXICON_RU['error_player_data_not_found'], show_alert=True)
         return
-    player_data = update_player_resources(player_data)
+    await check_and_complete_construction(user_id, snapshot)
+    await check_and_complete_training(user_id, snapshot)
+    player_data = update_player_resources(snapshot.player)
     update_player_data(user_id, player_data)
     
-    warehouse_level = player_data['buildings'].get('warehouse', 1)
-    capacity = WAREHOUSE_CAPACITY.get(warehouse_level, 1)
+    capacity = WAREHOUSE_CAPACITY.get(player_data.buildings[WAREHOUSE], 1)
     
     text = LEXICON_RU['base_info_title'] + '\n\n' + LEXICON_RU['base_info_text'].format(
-        capacity_bar=create_progress_bar(player_data['resources'], capacity),
-        percent_full=int((player_data['resources'] / capacity) * 100) if capacity > 0 else 0,
-        current_res=int(player_data['resources']),
+        capacity_bar=create_progress_bar(player_data.resources, capacity),
+        percent_full=int((player_data.resources / capacity) * 100) if capacity > 0 else 0,
+        current_res=int(player_data.resources),
         capacity_val=capacity,
-        active_army=player_data['army'].get('active', {}).get('soldier', 0),
-        reserve_army=player_data['army'].get('reserve', {}).get('soldier', 0)
+        active_army=player_data.active[SOLDIER],
+        reserve_army=player_data.reserve[SOLDIER]
     )
     
     processes_text = ""
-    construction_job = get_construction_queue(user_id)
+    construction_job = snapshot.construction_job
     if construction_job:
         _, _, bld_id, finish_time = construction_job
-        time_left = str(datetime.timedelta(seconds=max(0, int(finish_time - time.time()))))
+        time_left = str(datetime.timedelta(seconds=max(0, int(finish_time - game_clock.time()))))
         processes_text += '\n' + LEXICON_RU['construction_in_progress'].format(
             building_name=BUILDINGS[bld_id]['name'],
-            level=player_data['buildings'].get(bld_id, 0) + 1,
+            level=player_data.buildings[BUILDING_SLOT[bld_id]] + 1,
             time_left=time_left
         )
         
-    training_job = get_training_queue(user_id)
+    training_job = snapshot.training_job
     if training_job:
         _, unit_id, quantity, next_finish_time = training_job
-        time_left = str(datetime.timedelta(seconds=max(0, int(next_finish_time - time.time()))))
+        time_left = str(datetime.timedelta(seconds=max(0, int(next_finish_time - game_clock.time()))))
         processes_text += ('\n' if processes_text else '') + LEXICON_RU['training_in_progress'].format(
             unit_name=UNITS[unit_id]['name'],
             quantity=quantity,
@@ -932,14 +3278,10 @@ async def cq_show_base(callback: types.CallbackQuery, state: FSMContext):
     if processes_text:
         text += LEXICON_RU['base_processes_title'] + processes_text
 
-    builder = InlineKeyboardBuilder()
-    builder.button(text="🗂️ Распределение сил", callback_data="manage_army")
-    builder.button(text="↩️ Назад в штаб", callback_data="main_menu")
-    builder.adjust(1)
-    await callback.message.edit_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=builder.as_markup())
+    await callback.message.edit_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_base_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data == "manage_army")
+@callback_route("manage_army")
 async def cq_manage_army(callback: types.CallbackQuery, state: FSMContext):
     await show_army_management_menu(callback.from_user.id, state, message_to_edit=callback.message)
     
@@ -949,31 +3291,27 @@ async def show_army_management_menu(user_id: int, state: FSMContext, message_to_
     if not player_data: return
     
     text = LEXICON_RU['army_management_title'].format(
-        active_army=player_data['army']['active'].get('soldier', 0),
-        reserve_army=player_data['army']['reserve'].get('soldier', 0)
+        active_army=player_data.active[SOLDIER],
+        reserve_army=player_data.reserve[SOLDIER]
     )
-    builder = InlineKeyboardBuilder()
-    builder.button(text="➡️ В резерв", callback_data="move_to_reserve")
-    builder.button(text="⬅️ В штурмовой отряд", callback_data="move_to_active")
-    builder.button(text="↩️ Назад", callback_data="show_base")
-    builder.adjust(2, 1)
+    keyboard = get_army_management_keyboard()
 
     if message_to_edit:
         try:
-            await message_to_edit.edit_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=builder.as_markup())
+            await message_to_edit.edit_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboard)
         except TelegramAPIError:
              if message_to_answer:
-                await message_to_answer.answer(text, parse_mode=ParseMode.MARKDOWN, reply_markup=builder.as_markup())
+                await message_to_answer.answer(text, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboard)
     elif message_to_answer:
-         await message_to_answer.answer(text, parse_mode=ParseMode.MARKDOWN, reply_markup=builder.as_markup())
+         await message_to_answer.answer(text, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboard)
         
-@dp.callback_query(F.data == "move_to_reserve")
+@callback_route("move_to_reserve")
 async def cq_move_to_reserve(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(LEXICON_RU['move_to_reserve_prompt'])
     await state.set_state(ArmyManagementState.waiting_for_reserve_quantity)
     await callback.answer()
 
-@dp.callback_query(F.data == "move_to_active")
+@callback_route("move_to_active")
 async def cq_move_to_active(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(LEXICON_RU['move_to_active_prompt'])
     await state.set_state(ArmyManagementState.waiting_for_active_quantity)
@@ -987,13 +3325,14 @@ async def process_move_to_reserve(message: types.Message, state: FSMContext):
     quantity = int(message.text)
     player_data = get_player(message.from_user.id)
     if not player_data: return
-    active_army = player_data['army']['active'].get('soldier', 0)
+    active_army = player_data.active[SOLDIER]
     if quantity > active_army:
         await message.reply(LEXICON_RU['error_not_enough_units_in_active'].format(active_army=active_army))
         return
-    player_data['army']['active']['soldier'] -= quantity
-    player_data['army']['reserve']['soldier'] += quantity
-    update_player_data(message.from_user.id, player_data)
+    player_data.active[SOLDIER] -= quantity
+    player_data.reserve[SOLDIER] += quantity
+    update_player_data(message.from_user.id, player_data,
+                       [ledger.event(message.from_user.id, 'move_to_reserve', active=-quantity, reserve=quantity)])
     await message.reply(LEXICON_RU['move_to_reserve_success'].format(quantity=quantity))
     await show_army_management_menu(message.from_user.id, state, message_to_answer=message)
 
@@ -1005,37 +3344,39 @@ async def process_move_to_active(message: types.Message, state: FSMContext):
     quantity = int(message.text)
     player_data = get_player(message.from_user.id)
     if not player_data: return
-    reserve_army = player_data['army']['reserve'].get('soldier', 0)
+    reserve_army = player_data.reserve[SOLDIER]
     if quantity > reserve_army:
         await message.reply(LEXICON_RU['error_not_enough_units_in_reserve'].format(reserve_army=reserve_army))
         return
-    player_data['army']['reserve']['soldier'] -= quantity
-    player_data['army']['active']['soldier'] += quantity
-    update_player_data(message.from_user.id, player_data)
+    player_data.reserve[SOLDIER] -= quantity
+    player_data.active[SOLDIER] += quantity
+    update_player_data(message.from_user.id, player_data,
+                       [ledger.event(message.from_user.id, 'move_to_active', active=quantity, reserve=-quantity)])
     await message.reply(LEXICON_RU['move_to_active_success'].format(quantity=quantity))
     await show_army_management_menu(message.from_user.id, state, message_to_answer=message)
 
-@dp.callback_query(F.data == "show_buildings")
+@callback_route("show_buildings")
 async def cq_show_buildings_menu(callback: types.CallbackQuery):
-    await check_and_complete_construction(callback.from_user.id)
-    player_data = get_player(callback.from_user.id)
-    if not player_data: return
+    snapshot = get_player_snapshot(callback.from_user.id)
+    if not snapshot: return
+    await check_and_complete_construction(callback.from_user.id, snapshot)
     
-    await callback.message.edit_text(LEXICON_RU['buildings_menu_title'], reply_markup=get_buildings_menu_keyboard(player_data['buildings']))
+    await callback.message.edit_text(LEXICON_RU['buildings_menu_title'], reply_markup=get_buildings_menu_keyboard(snapshot.player.buildings))
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("view_building_"))
-async def cq_view_specific_building(callback: types.CallbackQuery, state: FSMContext):
+@callback_route(ViewBuildingCallback)
+async def cq_view_specific_building(callback: types.CallbackQuery, state: FSMContext, callback_data: ViewBuildingCallback):
     await state.clear()
     user_id = callback.from_user.id
-    bld_id = callback.data.replace("view_building_", "")
-    await check_and_complete_construction(user_id)
-    player_data = get_player(user_id)
-    if not player_data:
+    bld_id = callback_data.building_id
+    snapshot = get_player_snapshot(user_id)
+    if not snapshot:
         await callback.answer(LEXICON_RU['error_player_data_not_found'], show_alert=True)
         return
+    await check_and_complete_construction(user_id, snapshot)
+    player_data = snapshot.player
     
-    level = player_data['buildings'].get(bld_id, 0)
+    level = player_data.buildings[BUILDING_SLOT[bld_id]]
     bld_info = BUILDINGS[bld_id]
 
     text = LEXICON_RU['building_info'].format(
@@ -1058,7 +3399,7 @@ async def cq_view_specific_building(callback: types.CallbackQuery, state: FSMCon
         text += LEXICON_RU['building_info_barracks'].format(training_time=training_time)
     
     builder = InlineKeyboardBuilder()
-    construction_job = get_construction_queue(user_id)
+    construction_job = snapshot.construction_job
     
     if construction_job:
         text += f"\n\n{LEXICON_RU['builder_is_busy_long']}"
@@ -1072,7 +3413,7 @@ async def cq_view_specific_building(callback: types.CallbackQuery, state: FSMCon
                 cost=upgrade_cost,
                 build_time=upgrade_time_str
             )
-            builder.button(text="✨ Улучшить", callback_data=f"upgrade_{bld_id}")
+            builder.button(text="✨ Улучшить", callback_data=UpgradeBuildingCallback(building_id=bld_id))
         else:
             text += f"\n\n{LEXICON_RU['max_level_reached']}"
     
@@ -1086,38 +3427,39 @@ async def cq_view_specific_building(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("upgrade_"))
-async def cq_upgrade_building(callback: types.CallbackQuery):
+@callback_route(UpgradeBuildingCallback)
+async def cq_upgrade_building(callback: types.CallbackQuery, callback_data: UpgradeBuildingCallback):
     user_id = callback.from_user.id
-    bld_id = callback.data.replace("upgrade_", "")
-    if get_construction_queue(user_id):
+    bld_id = callback_data.building_id
+    snapshot = get_player_snapshot(user_id)
+    if not snapshot: return
+    if snapshot.construction_job:
         await callback.answer(LEXICON_RU['error_builder_busy'], show_alert=True)
         return
-    player_data = get_player(user_id)
-    if not player_data: return
+    player_data = snapshot.player
     update_player_resources(player_data)
-    level = player_data['buildings'].get(bld_id, 0)
+    level = player_data.buildings[BUILDING_SLOT[bld_id]]
     if level >= MAX_BUILDING_LEVEL:
         await callback.answer(LEXICON_RU['error_max_level_reached_alert'], show_alert=True)
         return
     cost = BUILDING_UPGRADE_COST.get(level + 1)
-    if cost and player_data['resources'] >= cost:
-        player_data['resources'] -= cost
-        update_player_data(user_id, player_data)
+    if cost and player_data.resources >= cost:
+        player_data.resources -= cost
+        update_player_data(user_id, player_data, [ledger.event(user_id, 'upgrade_spend', resources=-cost, ref=bld_id)])
         build_time_seconds = BUILDING_UPGRADE_TIME.get(level + 1, 0)
-        finish_time = int(time.time() + build_time_seconds)
+        finish_time = int(game_clock.time() + build_time_seconds)
         add_to_construction_queue(user_id, bld_id, finish_time)
         await callback.answer(LEXICON_RU['upgrade_started'].format(building_name=BUILDINGS[bld_id]['name']))
         await cq_show_buildings_menu(callback)
     else:
         await callback.answer(LEXICON_RU['error_not_enough_resources_alert'], show_alert=True)
 
-async def show_interactive_training_menu(callback: types.CallbackQuery, state: FSMContext, player_data: dict):
+async def show_interactive_training_menu(callback: types.CallbackQuery, state: FSMContext, player_data: PlayerState):
     state_data = await state.get_data()
     quantity_to_train = state_data.get('quantity_to_train', 1)
     unit_info = UNITS['soldier']
     unit_cost = unit_info['cost']
-    max_can_train = int(player_data['resources'] / unit_cost) if unit_cost > 0 else 0
+    max_can_train = int(player_data.resources / unit_cost) if unit_cost > 0 else 0
     if quantity_to_train > max_can_train: quantity_to_train = max_can_train
     if quantity_to_train < 1 and max_can_train > 0: quantity_to_train = 1
     elif max_can_train == 0: quantity_to_train = 0
@@ -1126,13 +3468,16 @@ async def show_interactive_training_menu(callback: types.CallbackQuery, state: F
     total_cost = unit_cost * quantity_to_train
     text = (LEXICON_RU['training_menu_title'].format(unit_name=unit_info['name']) + '\n\n' +
             LEXICON_RU['training_menu_stats'].format(hp=unit_info['stats']['hp'], attack=unit_info['stats']['attack'], cargo=unit_info['stats']['cargo_capacity']) + '\n\n' +
-            LEXICON_RU['training_production_info'].format(training_time=BARRACKS_TRAINING_TIME.get(player_data['buildings'].get('barracks', 1), 999), unit_cost=unit_cost) + '\n\n' +
-            LEXICON_RU['training_possibilities'].format(resources=int(player_data['resources']), quantity_to_train=quantity_to_train, max_can_train=max_can_train, total_cost=total_cost))
+            LEXICON_RU['training_production_info'].format(training_time=BARRACKS_TRAINING_TIME.get(player_data.buildings[BARRACKS], 999), unit_cost=unit_cost) + '\n\n' +
+            LEXICON_RU['training_possibilities'].format(resources=int(player_data.resources), quantity_to_train=quantity_to_train, max_can_train=max_can_train, total_cost=total_cost))
     builder = InlineKeyboardBuilder()
-    builder.button(text="-10", callback_data="train_sub_10"); builder.button(text="-1", callback_data="train_sub_1")
-    builder.button(text="+1", callback_data="train_add_1"); builder.button(text="+10", callback_data="train_add_10")
-    builder.button(text="Мин.", callback_data="train_set_1"); builder.button(text="Макс.", callback_data="train_set_max")
-    builder.button(text=f"✅ Подтвердить ({quantity_to_train} шт.)", callback_data="train_confirm")
+    builder.button(text="-10", callback_data=TrainingQuantityCallback(action='sub', amount=10))
+    builder.button(text="-1", callback_data=TrainingQuantityCallback(action='sub', amount=1))
+    builder.button(text="+1", callback_data=TrainingQuantityCallback(action='add', amount=1))
+    builder.button(text="+10", callback_data=TrainingQuantityCallback(action='add', amount=10))
+    builder.button(text="Мин.", callback_data=TrainingQuantityCallback(action='min'))
+    builder.button(text="Макс.", callback_data=TrainingQuantityCallback(action='max'))
+    builder.button(text=f"✅ Подтвердить ({quantity_to_train} шт.)", callback_data=TrainingQuantityCallback(action='confirm'))
     builder.button(text="❌ Отмена", callback_data="main_menu")
     builder.adjust(4, 2, 1, 1)
     try:
@@ -1140,13 +3485,15 @@ async def show_interactive_training_menu(callback: types.CallbackQuery, state: F
     except TelegramAPIError: pass
     await callback.answer()
 
-@dp.callback_query(F.data == "show_barracks_training")
+@callback_route("show_barracks_training")
 async def cq_start_training_session(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    training_job = get_training_queue(user_id)
+    snapshot = get_player_snapshot(user_id)
+    if not snapshot: return
+    training_job = snapshot.training_job
     if training_job:
         _, unit_id, quantity, next_finish_time = training_job
-        time_left = str(datetime.timedelta(seconds=max(0, int(next_finish_time - time.time()))))
+        time_left = str(datetime.timedelta(seconds=max(0, int(next_finish_time - game_clock.time()))))
         text = LEXICON_RU['barracks_busy_status'].format(
             unit_name=UNITS[unit_id]['name'],
             quantity=quantity,
@@ -1157,62 +3504,56 @@ async def cq_start_training_session(callback: types.CallbackQuery, state: FSMCon
         await callback.message.edit_text(text, reply_markup=builder.as_markup())
         await callback.answer()
         return
-    player_data = get_player(user_id)
-    if not player_data: return
     await state.set_state(TrainingState.selecting_quantity)
     await state.update_data(quantity_to_train=1)
-    await show_interactive_training_menu(callback, state, player_data)
+    await show_interactive_training_menu(callback, state, snapshot.player)
 
-@dp.callback_query(TrainingState.selecting_quantity, F.data.startswith("train_"))
-async def cq_adjust_training_quantity(callback: types.CallbackQuery, state: FSMContext):
-    action = callback.data.split("_")[1]
+@callback_route(TrainingQuantityCallback, state=TrainingState.selecting_quantity)
+async def cq_adjust_training_quantity(callback: types.CallbackQuery, state: FSMContext, callback_data: TrainingQuantityCallback):
+    action = callback_data.action
     player_data = get_player(callback.from_user.id)
     state_data = await state.get_data()
     quantity = state_data.get('quantity_to_train', 1)
-    max_can_train = int(player_data['resources'] / UNITS['soldier']['cost']) if UNITS['soldier']['cost'] > 0 else 0
-    if action == "add": quantity += int(callback.data.split("_")[2])
-    elif action == "sub": quantity -= int(callback.data.split("_")[2])
-    elif action == "set": quantity = max_can_train if callback.data.split("_")[2] == "max" else 1
+    max_can_train = int(player_data.resources / UNITS['soldier']['cost']) if UNITS['soldier']['cost'] > 0 else 0
+    if action == "add": quantity += callback_data.amount
+    elif action == "sub": quantity -= callback_data.amount
+    elif action == "max": quantity = max_can_train
+    elif action == "min": quantity = 1
     elif action == "confirm":
         if quantity <= 0:
             await callback.answer("Не выбрано ни одного юнита для тренировки.", show_alert=True)
             return
         total_cost = UNITS['soldier']['cost'] * quantity
-        if player_data['resources'] < total_cost:
+        if player_data.resources < total_cost:
             await callback.answer(LEXICON_RU['error_not_enough_resources_alert'], show_alert=True)
             return
-        player_data['resources'] -= total_cost
-        update_player_data(callback.from_user.id, player_data)
-        barracks_level = player_data['buildings'].get('barracks', 1)
-        training_time_per_unit = BARRACKS_TRAINING_TIME.get(barracks_level, 999)
-        next_finish_time = int(time.time() + training_time_per_unit)
+        player_data.resources -= total_cost
+        update_player_data(callback.from_user.id, player_data,
+                           [ledger.event(callback.from_user.id, 'training_spend', resources=-total_cost, ref=f"soldier x{quantity}")])
+        training_time_per_unit = BARRACKS_TRAINING_TIME.get(player_data.buildings[BARRACKS], 999)
+        next_finish_time = int(game_clock.time() + training_time_per_unit)
         add_to_training_queue(callback.from_user.id, 'soldier', quantity, next_finish_time)
         await state.clear()
         await callback.message.edit_text(
             LEXICON_RU['training_started'],
-            reply_markup=InlineKeyboardBuilder().button(text="🏕️ Перейти на базу", callback_data="show_base").as_markup())
+            reply_markup=get_back_keyboard("🏕️ Перейти на базу", "show_base"))
         return
     await state.update_data(quantity_to_train=quantity)
     await show_interactive_training_menu(callback, state, player_data)
 
-@dp.callback_query(F.data == "show_rating")
+@callback_route("show_rating")
 async def cq_show_rating(callback: types.CallbackQuery):
-    builder = InlineKeyboardBuilder()
-    builder.button(text="🎖️ Легендарные полководцы", callback_data="rating_power")
-    builder.button(text="⚔️ Великие завоеватели", callback_data="rating_attack_wins")
-    builder.button(text="🛡️ Неприступные крепости", callback_data="rating_defense_wins")
-    builder.button(text="💰 Военные магнаты", callback_data="rating_resources")
-    builder.button(text="↩️ Назад в штаб", callback_data="main_menu")
-    builder.adjust(1)
-    await callback.message.edit_text(LEXICON_RU['rating_menu_title'], parse_mode=ParseMode.MARKDOWN, reply_markup=builder.as_markup())
+    await callback.message.edit_text(LEXICON_RU['rating_menu_title'], parse_mode=ParseMode.MARKDOWN, reply_markup=get_rating_menu_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("rating_"))
-async def cq_show_specific_rating(callback: types.CallbackQuery):
-    category = callback.data.replace("rating_", "")
+rating_page_cache = TTLCache(RATING_CACHE_TTL, maxsize=16)
+
+def render_rating_page(category: str) -> str:
     medals = ["🥇", "🥈", "🥉"]
     rating_text = ""
     titles = {"power": LEXICON_RU['rating_power_title'],"attack_wins": LEXICON_RU['rating_attack_wins_title'],"defense_wins": LEXICON_RU['rating_defense_wins_title'],"resources": LEXICON_RU['rating_resources_title']}
+    if category in LEADERBOARD_PERIODS:
+        return render_leaderboard_page(category)
     rating_text += titles[category]
     if category == "power":
         power_ratings = sorted(
@@ -1230,24 +3571,45 @@ async def cq_show_specific_rating(callback: types.CallbackQuery):
         else:
             for i, (name, value) in enumerate(top_players):
                 rating_text += LEXICON_RU['rating_line'].format(medal=medals[i], rank=i + 1, name=name, metric=metrics[category], value=int(value))
-    builder = InlineKeyboardBuilder().button(text="↩️ Назад к Залу славы", callback_data="show_rating")
-    await callback.message.edit_text(rating_text, parse_mode=ParseMode.MARKDOWN, reply_markup=builder.as_markup())
+    return rating_text
+
+def render_leaderboard_page(period: str) -> str:
+    medals = ["🥇", "🥈", "🥉"]
+    rating_text = LEXICON_RU[f'rating_{period}_title']
+    for metric in LEADERBOARD_METRICS:
+        rating_text += LEXICON_RU['rating_period_section'].format(title=LEXICON_RU[f'rating_period_{metric}'])
+        top_players = get_leaderboard(period, metric)
+        if not top_players:
+            rating_text += LEXICON_RU['rating_no_players'] + '\n'
+        for i, (name, value) in enumerate(top_players):
+            rating_text += LEXICON_RU['rating_line'].format(medal=medals[i], rank=i + 1, name=name,
+                                                            metric=LEXICON_RU[f'rating_period_{metric}_metric'], value=value)
+    return rating_text
+
+@callback_route(RatingCallback)
+async def cq_show_specific_rating(callback: types.CallbackQuery, callback_data: RatingCallback):
+    # Одна и та же страница нужна всем игрокам сразу, поэтому её собираем раз в RATING_CACHE_TTL секунд
+    rating_text = rating_page_cache.get(callback_data.category)
+    if rating_text is None:
+        rating_text = render_rating_page(callback_data.category)
+        rating_page_cache.put(callback_data.category, rating_text)
+    await callback.message.edit_text(rating_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_back_keyboard("↩️ Назад к Залу славы", "show_rating"))
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("show_targets_page_"))
-async def cq_show_targets(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[-1])
+@callback_route(TargetsPageCallback)
+async def cq_show_targets(callback: types.CallbackQuery, callback_data: TargetsPageCallback):
+    page = callback_data.page
     page_size = 5
     cooldown_finish_time = get_attack_cooldown(callback.from_user.id)
     if cooldown_finish_time:
-        remaining_seconds = max(0, int(cooldown_finish_time - time.time()))
+        remaining_seconds = max(0, int(cooldown_finish_time - game_clock.time()))
         minutes, seconds = divmod(remaining_seconds, 60)
         await callback.answer(LEXICON_RU['attack_cooldown'].format(time_left=f"{minutes:02d}:{seconds:02d}"), show_alert=True)
         return
         
     all_targets = get_all_targets(callback.from_user.id)
     if not all_targets:
-        await callback.message.edit_text(LEXICON_RU['no_targets_available'], reply_markup=InlineKeyboardBuilder().button(text="↩️ Назад в штаб", callback_data="main_menu").as_markup())
+        await callback.message.edit_text(LEXICON_RU['no_targets_available'], reply_markup=get_back_keyboard("↩️ Назад в штаб", "main_menu"))
         return
     
     total_pages = (len(all_targets) + page_size - 1) // page_size
@@ -1261,19 +3623,19 @@ async def cq_show_targets(callback: types.CallbackQuery):
     for target in targets_on_page:
         if target['type'] == 'player':
             button_text = LEXICON_RU['target_player_entry'].format(name=target['name'], power=target['power'], cc_level=target['cc_level'])
-            callback_data = f"attack_player_{target['id']}"
+            attack_data = AttackCallback(target_type='player', target_id=target['id'])
         else: # npc
             button_text = LEXICON_RU['target_npc_entry'].format(name=target['name'], power=target['power'])
-            callback_data = f"attack_npc_{target['id']}"
-        builder.button(text=button_text, callback_data=callback_data)
+            attack_data = AttackCallback(target_type='npc', target_id=target['id'])
+        builder.button(text=button_text, callback_data=attack_data)
 
     builder.adjust(1) # Это гарантирует, что каждая кнопка будет на новой строке
 
     nav_row = []
     if page > 1:
-        nav_row.append(types.InlineKeyboardButton(text="◀️ Пред.", callback_data=f"show_targets_page_{page - 1}"))
+        nav_row.append(types.InlineKeyboardButton(text="◀️ Пред.", callback_data=TargetsPageCallback(page=page - 1).pack()))
     if page < total_pages:
-        nav_row.append(types.InlineKeyboardButton(text="След. ▶️", callback_data=f"show_targets_page_{page + 1}"))
+        nav_row.append(types.InlineKeyboardButton(text="След. ▶️", callback_data=TargetsPageCallback(page=page + 1).pack()))
     if nav_row:
         builder.row(*nav_row)
 
@@ -1282,13 +3644,31 @@ async def cq_show_targets(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("attack_"))
-async def cq_attack(callback: types.CallbackQuery, state: FSMContext):
+battle_report_cache = TTLCache(BATTLE_REPORT_CACHE_TTL, maxsize=BATTLE_REPORT_CACHE_SIZE)
+
+def render_battle_report(battle: dict, side: str) -> str:
+    a_initial, a_losses = battle['a_initial'], battle['a_losses']
+    d_initial, d_losses = battle['d_initial'], battle['d_losses']
+    is_attacker_win = bool(battle['is_attacker_win'])
+    attacker_stats = LEXICON_RU['battle_report_attacker_stats'].format(attacker_name=battle['attacker_name'], losses=a_losses, initial=a_initial, loss_percent=round(a_losses / a_initial * 100 if a_initial > 0 else 0))
+    defender_stats = LEXICON_RU['battle_report_defender_stats'].format(defender_name=battle['defender_name'], losses=d_losses, initial=d_initial, loss_percent=round(d_losses / d_initial * 100 if d_initial > 0 else 0))
+    battle_time = datetime.datetime.fromtimestamp(battle['timestamp']).strftime('%d.%m.%Y %H:%M')
+    if side == 'attacker':
+        return (LEXICON_RU['battle_report_title'] + '\n\n' +
+            LEXICON_RU['battle_report_header'].format(operation_type="Нападение", target_name=battle['defender_name'], datetime=battle_time, luck_modifier=battle['luck_modifier'], result="ПОБЕДА" if is_attacker_win else "ПОРАЖЕНИЕ") +
+            LEXICON_RU['battle_report_loot'].format(looted_resources=battle['looted']) +
+            attacker_stats + defender_stats)
+    return (LEXICON_RU['battle_report_title'] + '\n\n' +
+        LEXICON_RU['battle_report_header'].format(operation_type="Оборона", target_name=battle['attacker_name'], datetime=battle_time, luck_modifier=battle['luck_modifier'], result="ОБОРОНА ПРОВАЛЕНА" if is_attacker_win else "ОБОРОНА УСПЕШНА") +
+        LEXICON_RU['battle_report_loot_lost'].format(looted_resources=battle['looted']) +
+        defender_stats + attacker_stats)
+
+@callback_route(AttackCallback)
+async def cq_attack(callback: types.CallbackQuery, state: FSMContext, callback_data: AttackCallback):
     await callback.answer("Симуляция боя...")
     try:
         await state.clear()
-        _, target_type, target_id_str = callback.data.split("_", 2)
-        target_id = int(target_id_str)
+        target_type, target_id = callback_data.target_type, callback_data.target_id
         
         attacker_id = callback.from_user.id
         attacker_data = get_player(attacker_id)
@@ -1296,124 +3676,355 @@ async def cq_attack(callback: types.CallbackQuery, state: FSMContext):
         if not attacker_data:
             return
 
-        a_initial_army = attacker_data['army']['active'].get('soldier', 0)
+        a_initial_army = attacker_data.active[SOLDIER]
         if a_initial_army == 0:
             await callback.answer(LEXICON_RU['error_no_army_to_attack_alert'], show_alert=True)
             return
 
-        defender_data = None
-        if target_type == 'player':
-            defender_data = get_player(target_id)
-            if defender_data:
-                defender_data['type'] = 'player'
-        elif target_type == 'npc':
-            npc_data = get_npc_by_id(target_id)
-            if npc_data:
-                defender_data = {
-                    'id': npc_data['id'],
-                    'name': npc_data['name'],
-                    'army': npc_data['army'],
-                    'resources': npc_data['resources'],
-                    'buildings': {},
-                    'type': 'npc'
-                }
-        
-        if not defender_data:
-             await callback.message.edit_text("Цель не найдена или уже уничтожена.", reply_markup=InlineKeyboardBuilder().button(text="↩️ Назад", callback_data="show_targets_page_1").as_markup())
+        outcome = resolve_battle(attacker_id, target_type, target_id)
+        if not outcome:
+             await callback.message.edit_text("Цель не найдена или уже уничтожена.", reply_markup=get_back_keyboard("↩️ Назад", TargetsPageCallback(page=1).pack()))
              return
 
-        d_initial_army = defender_data['army'].get('soldier', 0)
-        s_stats = UNITS['soldier']['stats']
-        
-        luck_modifier = random.uniform(-LUCK_MODIFIER_RANGE, LUCK_MODIFIER_RANGE)
-        a_total_damage = a_initial_army * s_stats['attack'] * (1 + luck_modifier)
-        defender_losses = min(d_initial_army, round(a_total_damage / s_stats['hp']))
-        d_survivors = d_initial_army - defender_losses
-        d_total_damage = d_survivors * s_stats['attack']
-        attacker_losses = min(a_initial_army, round(d_total_damage / s_stats['hp']))
-        a_survivors = a_initial_army - attacker_losses
-        is_attacker_win = a_survivors > d_survivors if defender_data['type'] == 'npc' else attacker_losses < defender_losses
-
-        looted_resources = 0
-        if is_attacker_win:
-            attacker_data['attack_wins'] += 1
-            if defender_data['type'] == 'npc':
-                deactivate_npc(target_id)
-            
-            warehouse_level = defender_data.get('buildings', {}).get('warehouse', 1)
-            capacity = WAREHOUSE_CAPACITY.get(warehouse_level, 0)
-            protected_resources = capacity * WAREHOUSE_PROTECTION_PERCENT if defender_data['type'] == 'player' else 0
-            available_for_looting = max(0, defender_data['resources'] - protected_resources)
-            cargo_capacity = a_survivors * s_stats['cargo_capacity']
-            looted_resources = min(available_for_looting, cargo_capacity)
-            
-            attacker_data['resources'] += looted_resources
-            if defender_data['type'] == 'player':
-                defender_data['resources'] -= looted_resources
-        
-        attacker_data['army']['active']['soldier'] = a_survivors
-        update_player_data(attacker_id, attacker_data)
+        attacker_report = render_battle_report(outcome['battle'], 'attacker')
+        battle_report_cache.put((outcome['attacker_report_id'], attacker_id), attacker_report)
 
-        if defender_data['type'] == 'player':
-            defender_data['army']['active']['soldier'] = d_survivors
-            defender_data['defense_wins'] = defender_data.get('defense_wins', 0) + (0 if is_attacker_win else 1)
-            update_player_data(target_id, defender_data)
-        
-        now_str = datetime.datetime.now().strftime('%d.%m.%Y %H:%M')
-        
-        attacker_report = (LEXICON_RU['battle_report_title'] + '\n\n' + 
-            LEXICON_RU['battle_report_header'].format(operation_type="Нападение", target_name=defender_data['name'], datetime=now_str, luck_modifier=luck_modifier, result="ПОБЕДА" if is_attacker_win else "ПОРАЖЕНИЕ") +
-            LEXICON_RU['battle_report_loot'].format(looted_resources=int(looted_resources)) +
-            LEXICON_RU['battle_report_attacker_stats'].format(attacker_name=attacker_data['name'], losses=attacker_losses, initial=a_initial_army, loss_percent=round(attacker_losses / a_initial_army * 100 if a_initial_army > 0 else 0)) +
-            LEXICON_RU['battle_report_defender_stats'].format(defender_name=defender_data['name'], losses=defender_losses, initial=d_initial_army, loss_percent=round(defender_losses / d_initial_army * 100 if d_initial_army > 0 else 0)))
-        
-        if defender_data['type'] == 'player':
-            defender_report = (LEXICON_RU['battle_report_title'] + '\n\n' + 
-                LEXICON_RU['battle_report_header'].format(operation_type="Оборона", target_name=attacker_data['name'], datetime=now_str, luck_modifier=luck_modifier, result="ОБОРОНА ПРОВАЛЕНА" if is_attacker_win else "ОБОРОНА УСПЕШНА") +
-                LEXICON_RU['battle_report_loot_lost'].format(looted_resources=int(looted_resources)) +
-                LEXICON_RU['battle_report_defender_stats'].format(defender_name=defender_data['name'], losses=defender_losses, initial=d_initial_army, loss_percent=round(defender_losses / d_initial_army * 100 if d_initial_army > 0 else 0)) +
-                LEXICON_RU['battle_report_attacker_stats'].format(attacker_name=attacker_data['name'], losses=attacker_losses, initial=a_initial_army, loss_percent=round(attacker_losses / a_initial_army * 100 if a_initial_army > 0 else 0)))
-            
-            report_id = add_battle_report(target_id, defender_report)
+        if outcome['defender'] is not None:
+            # Отчет защитника не собираем: он отрисуется, только если игрок его откроет
             try:
-                await bot.send_message(target_id, LEXICON_RU['attack_notification'], reply_markup=InlineKeyboardBuilder().button(text="👁️ Посмотреть отчет", callback_data=f"view_report_{report_id}").as_markup())
+                await bot.send_message(target_id, LEXICON_RU['attack_notification'], reply_markup=InlineKeyboardBuilder().button(text="👁️ Посмотреть отчет", callback_data=ViewReportCallback(report_id=outcome['defender_report_id'])).as_markup())
             except TelegramAPIError as e:
                 logging.error(f"Не удалось отправить уведомление защитнику {target_id}: {e}")
 
-        await callback.message.edit_text(attacker_report, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardBuilder().button(text="↩️ В штаб", callback_data="main_menu").as_markup())
-        set_attack_cooldown(attacker_id, int(time.time() + ATTACK_COOLDOWN_SECONDS))
+        await callback.message.edit_text(attacker_report, parse_mode=ParseMode.MARKDOWN, reply_markup=get_back_keyboard("↩️ В штаб", "main_menu"))
+        set_attack_cooldown(attacker_id, int(game_clock.time() + ATTACK_COOLDOWN_SECONDS))
 
     except Exception as e:
         logging.error(f"КРИТИЧЕСКАЯ ОШИБКА В БОЮ: {e}", exc_info=True)
-        await callback.message.edit_text(LEXICON_RU['critical_battle_error'], reply_markup=InlineKeyboardBuilder().button(text="↩️ В штаб", callback_data="main_menu").as_markup())
-
-@dp.callback_query(F.data.startswith("view_report_"))
-async def cq_view_report(callback: types.CallbackQuery):
-    report_id = int(callback.data.split("_")[2])
-    report_text = get_battle_report(report_id)
+        await callback.message.edit_text(LEXICON_RU['critical_battle_error'], reply_markup=get_back_keyboard("↩️ В штаб", "main_menu"))
+
+@callback_route(ViewReportCallback)
+async def cq_view_report(callback: types.CallbackQuery, callback_data: ViewReportCallback):
+    cache_key = (callback_data.report_id, callback.from_user.id)
+    report_text = battle_report_cache.get(cache_key)
+    if report_text is None:
+        record = get_battle_report(*cache_key)
+        if record:
+            report_text, battle, side = record
+            if battle is not None:
+                report_text = render_battle_report(battle, side)
+            battle_report_cache.put(cache_key, report_text)
     if report_text:
         await callback.message.answer(report_text, parse_mode=ParseMode.MARKDOWN)
         await callback.answer()
     else:
         await callback.answer("Отчет не найден.", show_alert=True)
+
+@callback_route(BattleJournalCallback)
+async def cq_battle_journal(callback: types.CallbackQuery, callback_data: BattleJournalCallback):
+    page = max(1, callback_data.page)
+    total, entries = get_battle_journal(callback.from_user.id, BATTLE_JOURNAL_PAGE_SIZE, (page - 1) * BATTLE_JOURNAL_PAGE_SIZE)
+    if not total:
+        await callback.message.edit_text(LEXICON_RU['battle_journal_empty'], parse_mode=ParseMode.MARKDOWN,
+                                         reply_markup=get_back_keyboard("↩️ Назад в штаб", "main_menu"))
+        await callback.answer()
+        return
+    total_pages = (total + BATTLE_JOURNAL_PAGE_SIZE - 1) // BATTLE_JOURNAL_PAGE_SIZE
+    if page > total_pages:
+        # Кнопка из старого сообщения может вести за последнюю страницу, если отчеты успели удалить
+        page = total_pages
+        total, entries = get_battle_journal(callback.from_user.id, BATTLE_JOURNAL_PAGE_SIZE, (page - 1) * BATTLE_JOURNAL_PAGE_SIZE)
+    text = LEXICON_RU['battle_journal_title'].format(current_page=page, total_pages=total_pages)
+    builder = InlineKeyboardBuilder()
+    for index, (report_id, timestamp, opponent_name, outcome, loot) in enumerate(entries, start=1):
+        text += '\n' + LEXICON_RU['battle_journal_line'].format(
+            index=index,
+            datetime=datetime.datetime.fromtimestamp(timestamp).strftime('%d.%m %H:%M'),
+            outcome=LEXICON_RU.get(f'battle_journal_outcome_{outcome}', LEXICON_RU['battle_journal_outcome_unknown']),
+            opponent_name=escape_markdown(opponent_name) if opponent_name else '—',
+            loot=loot or 0)
+        builder.button(text=f"📄 {index}", callback_data=ViewReportCallback(report_id=report_id))
+    if entries:
+        builder.adjust(len(entries))
+    nav_row = []
+    if page > 1:
+        nav_row.append(types.InlineKeyboardButton(text="◀️ Пред.", callback_data=BattleJournalCallback(page=page - 1).pack()))
+    if page < total_pages:
+        nav_row.append(types.InlineKeyboardButton(text="След. ▶️", callback_data=BattleJournalCallback(page=page + 1).pack()))
+    if nav_row:
+        builder.row(*nav_row)
+    builder.row(types.InlineKeyboardButton(text="↩️ Назад в штаб", callback_data="main_menu"))
+    await callback.message.edit_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=builder.as_markup())
+    await callback.answer()
+
+
+@dp.callback_query()
+async def dispatch_callback(callback: types.CallbackQuery, callback_route: CallbackRoute, **data):
+    # Единственный обработчик callback_query: маршрут уже выбран в CallbackRouterMiddleware
+    return await callback_route.handler.call(callback, **data)
+
+# ==============================================================================
+# --- РЕГИСТРАЦИЯ MIDDLEWARE ---
+# ==============================================================================
+dp.pre_filter = filter_group_noise
+dp.user_flow = UserFlowControl(THROTTLE_RATE, THROTTLE_BURST)
+dp.update.outer_middleware(UpdateRecorderMiddleware())
+dp.update.outer_middleware(ConcurrencyLimitMiddleware(MAX_CONCURRENT_UPDATES))
+dp.update.outer_middleware(OnboardingCancelMiddleware())
+dp.callback_query.outer_middleware(CallbackRouterMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+register_session_middlewares(bot.session)
+
+
 # ==============================================================================
 # --- ОСНОВНАЯ ФУНКЦИЯ ---
 # ==============================================================================
-async def main():
+async def replay_updates(path: str):
+    global DATABASE_NAME, rng_session_seed
+    # Прогоняем записанный трафик по копии снимка БД, время и удача берутся из лога
+    DATABASE_NAME = path + '.replay.db'
+    shutil.copyfile(path + '.db', DATABASE_NAME)
     init_db()
+    bot.session = ReplaySession()
+    register_session_middlewares(bot.session)
+
+    timings = []
+    started = time.perf_counter()
+    with open(path, encoding='utf-8') as log_file:
+        for line in log_file:
+            record = json.loads(line)
+            game_clock.freeze(record['ts'])
+            if record['kind'] == 'header':
+                rng_session_seed = record['seed']
+                continue
+            step_started = time.perf_counter()
+            if record['kind'] == 'update':
+                update = types.Update.model_validate(record['update'], context={'bot': bot})
+                label = describe_update(update)
+                await dp.feed_update(bot, update)
+            else:
+                label = f"job {record['name']}"
+                await SCHEDULED_JOBS[record['name']]()
+            timings.append((time.perf_counter() - step_started, label))
+    total = time.perf_counter() - started
+    game_clock.freeze(None)
+    ledger.flush()
+
+    durations = sorted(duration for duration, _ in timings)
+    if durations:
+        logging.info(f"Replay: {len(durations)} events in {total:.3f}s, "
+                     f"p50 {durations[len(durations) // 2] * 1000:.1f} ms, "
+                     f"p95 {durations[int(len(durations) * 0.95)] * 1000:.1f} ms, "
+                     f"max {durations[-1] * 1000:.1f} ms, API calls: {bot.session.requests_count}")
+        for duration, label in sorted(timings, reverse=True)[:10]:
+            logging.info(f"  {duration * 1000:8.1f} ms  {label}")
+    logging.info(f"Replay DB digest: {database_digest()}")
+
+
+metrics_runner: web.AppRunner | None = None
+
+
+async def on_startup(bot: Bot):
+    global update_recorder, metrics_runner
+    if UPDATES_RECORD_FILE:
+        update_recorder = UpdateRecorder(UPDATES_RECORD_FILE)
+        update_recorder.start(rng_session_seed)
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server()
+    start_background_task(loop_watchdog.run())
     await set_main_menu(bot)
-    
+
     scheduler.add_job(check_bonus_notifications, 'interval', minutes=15)
-    scheduler.add_job(manage_npc_spawns, 'interval', hours=1)
+    scheduler.add_job(manage_npc_spawns, 'interval', minutes=NPC_ENGINE_INTERVAL_MINUTES)
+    scheduler.add_job(purge_stale_fsm_states, 'interval', hours=1)
+    scheduler.add_job(prune_battle_reports, 'cron', hour=4, minute=30)
+    scheduler.add_job(archive_inactive_players, 'cron', hour=5, minute=0)
+    scheduler.add_job(maintain_database, 'cron', hour=4, minute=0)
+    scheduler.add_job(report_database_size, 'interval', seconds=DB_SIZE_REPORT_SECONDS)
+    if BACKUP_INTERVAL_HOURS:
+        scheduler.add_job(backup_database_job, 'interval', hours=BACKUP_INTERVAL_HOURS)
     scheduler.start()
+    onboarding_scheduler.start()
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(WEBHOOK_BASE_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS,
+                              allowed_updates=dp.resolve_used_update_types())
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+
+
+async def on_shutdown():
+    # Вебхук не снимаем: при выкатке за балансировщиком его продолжают обслуживать другие экземпляры
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    ledger.flush()
+    if update_recorder:
+        update_recorder.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    logging.info("Бот и планировщик остановлены.")
+
+
+async def run_webhook():
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
 
 
-if __name__ == "__main__":
+# ==============================================================================
+# --- МНОГОПРОЦЕССНЫЙ РЕЖИМ ---
+# ==============================================================================
+# Фронт один получает апдейты и запускает планировщик (задачи выполняются ровно один раз),
+# воркеры обрабатывают апдейты. Все апдейты одного игрока уходят в один воркер,
+# поэтому их порядок и локальные кэши (FSM и т.п.) остаются согласованными.
+def get_update_user_id(update: types.Update) -> int | None:
+    user = getattr(update.event, 'from_user', None)
+    return user.id if user else None
+
+
+def get_update_shard(update: types.Update, shards: int) -> int:
+    user_id = get_update_user_id(update)
+    return user_id % shards if user_id is not None else 0
+
+
+def start_worker(context, index: int, queue):
+    worker = context.Process(target=worker_entry, args=(index, queue), name=f"wog-worker-{index}", daemon=True)
+    worker.start()
+    return worker
+
+
+async def supervise_workers(context, workers: list, queues: list, stop_event: asyncio.Event) -> bool:
+    # Очередь упавшего воркера не теряется: перезапущенный процесс дочитывает её с того же места
+    restarts = collections.deque()
+    while not stop_event.is_set():
+        await asyncio.sleep(WORKER_CHECK_SECONDS)
+        if stop_event.is_set():
+            break
+        for index, worker in enumerate(workers):
+            if worker.is_alive():
+                continue
+            now = time.monotonic()
+            while restarts and restarts[0] < now - 60:
+                restarts.popleft()
+            if len(restarts) >= WORKER_MAX_RESTARTS_PER_MINUTE:
+                logging.critical(f"Worker {index} died (exit code {worker.exitcode}) and workers keep crashing, "
+                                 f"stopping the front")
+                stop_event.set()
+                return False
+            restarts.append(now)
+            logging.error(f"Worker {index} died with exit code {worker.exitcode}, restarting")
+            metrics.inc('worker_restarts_total', worker=str(index))
+            workers[index] = start_worker(context, index, queues[index])
+    return True
+
+
+async def run_front(worker_count: int):
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(worker_count)]
+    workers = [start_worker(context, index, queues[index]) for index in range(worker_count)]
+
+    await on_startup(bot)
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    supervisor = start_background_task(supervise_workers(context, workers, queues, stop_event))
+    logging.info(f"Front process started with {worker_count} workers")
     try:
+        while not stop_event.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates,
+                                                request_timeout=POLLING_TIMEOUT + 10)
+            except TelegramNetworkError as e:
+                logging.warning(f"Polling failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                # Шум из групп отсекаем ещё до очереди воркера
+                if filter_group_noise(update):
+                    continue
+                if update_recorder:
+                    update_recorder.record_update(update, game_clock.time())
+                queues[get_update_shard(update, worker_count)].put(
+                    update.model_dump_json(exclude_none=True, by_alias=True))
+                if update.message and (update.message.text or '').startswith('/start'):
+                    # Шаги обучения новичку поставит воркер; досылку будим к сроку первого шага
+                    loop.call_later(min(ONBOARDING_STEP_DELAYS.values()), onboarding_scheduler.notify)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            await loop.run_in_executor(None, worker.join, 30)
+        await on_shutdown()
+        await bot.session.close()
+    if supervisor.done() and supervisor.result() is False:
+        # Ненулевой код выхода - чтобы systemd/докер перезапустили сервис целиком
+        sys.exit(1)
+
+
+def worker_entry(index: int, queue):
+    asyncio.run(run_worker(index, queue))
+
+
+async def run_worker(index: int, queue):
+    # Сигналы обрабатывает фронт; воркер дорабатывает начатое и завершается, получив None из очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT + 1 + index)
+    start_background_task(loop_watchdog.run())
+    loop = asyncio.get_running_loop()
+    in_flight = set()
+    logging.info(f"Worker {index} started")
+    while True:
+        raw_update = await loop.run_in_executor(None, queue.get)
+        if raw_update is None:
+            break
+        update = types.Update.model_validate_json(raw_update, context={'bot': bot})
+        # Порядок апдейтов одного игрока сохраняет UserFlowControl: задачи встают в его очередь по порядку
+        task = start_background_task(dp.feed_update(bot, update))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    if in_flight:
+        await asyncio.wait(in_flight, timeout=30)
+    ledger.flush()
+    await bot.session.close()
+    logging.info(f"Worker {index} stopped")
+
+
+async def main():
+    init_db()
+    if WORKER_PROCESSES:
+        await run_front(WORKER_PROCESSES)
+        return
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if WEBHOOK_BASE_URL:
+        await run_webhook()
+    else:
+        await dp.start_polling(bot)
+
+
+if __name__ == "__main__":
+    if UPDATES_REPLAY_FILE:
+        asyncio.run(replay_updates(UPDATES_REPLAY_FILE))
+    else:
         asyncio.run(main())
-    except (KeyboardInterrupt, SystemExit):
-        scheduler.shutdown()
-        logging.info("Бот и планировщик остановлены.")